@@ -0,0 +1,464 @@
+import os
+import sys
+import time
+import subprocess
+import random
+import patterns
+import chemtagger
+import chemtagger_server
+from tabulate import tabulate
+
+COMPOUNDS = ['glucose', 'fructose', 'atp', 'adp', 'nadh', 'nad+', 'pyruvate',
+             'l-lactate', 'acetyl-coa', 'coenzyme a', 'citrate', 'oxaloacetate',
+             'glutamate', '2-oxoglutarate', 'ammonia', 'water', 'phosphate']
+SEPARATORS = [' ', ' and ', ' with ', ', ', ' , ', ' (', ') ', ' and with ']
+# words that bring a sentence closer to matching a pattern
+TRIGGERS = ['conversion', 'converted', 'produced', 'oxidized', 'interconversion',
+            'yields', 'metabolites', 'from', 'to', 'into', 'by', 'of', 'are',
+            'and', '<-->']
+FILLER = ['the', 'enzyme', 'convert', 'to', 'in', 'presence', 'of', 'yield',
+          'was', 'measured', 'activity', 'is', 'produc', 'by', '->']
+
+
+def tagged_sentence(rng, compounds):
+    '''
+    Generates a tagged sentence with roughly the given number of compounds
+    in runs of one to eight separated by filler words.
+    '''
+    words = []
+    while compounds > 0:
+        run = min(rng.randint(1, 8), compounds)
+        compounds -= run
+        chems = ['$%s$chem' % rng.choice(COMPOUNDS) for i in range(run)]
+        listed = chems[0]
+        for chem in chems[1:]:
+            listed += rng.choice(SEPARATORS) + chem
+        words.append(listed)
+        words.extend(rng.choice(FILLER) for i in range(rng.randint(1, 6)))
+    return ' '.join(words)
+
+
+def best_of(func, sentences, repeat=5):
+    '''Returns the fastest of several timed runs of func over sentences'''
+    times = []
+    for i in range(repeat):
+        began = time.time()
+        for sentence in sentences:
+            func(sentence)
+        times.append(time.time() - began)
+    return min(times)
+
+
+def bench_group_list(count=200):
+    '''
+    Compares the LIST_PATTERN substitution with the group_list scanner on
+    sentences of increasing numbers of compounds, and on a chemical followed
+    by a long run of whitespace, which LIST_PATTERN backtracks over.
+    '''
+    rng = random.Random(0)
+    cases = []
+    for compounds in [5, 20, 100, 500, 2000]:
+        cases.append(('%i compounds' % compounds,
+                      [tagged_sentence(rng, compounds) for i in range(count)]))
+    for spaces in [1000, 4000]:
+        cases.append(('%i spaces' % spaces,
+                      ['$atp$chem' + ' ' * spaces + 'adp']))
+    table = []
+    for name, sentences in cases:
+        for sentence in sentences:
+            assert patterns.group_list(sentence) == patterns.LIST_PATTERN.sub(
+                '{\g<0>}chem_list', sentence)
+        regex_time = best_of(lambda x: patterns.LIST_PATTERN.sub(
+            '{\g<0>}chem_list', x), sentences)
+        scan_time = best_of(patterns.group_list, sentences)
+        table.append([name, len(sentences[0]), regex_time * 1000,
+                      scan_time * 1000, regex_time / scan_time])
+    print tabulate(table, ['Sentences', 'Length', 'Regex (ms)',
+                           'Scanner (ms)', 'Speedup'], tablefmt='simple')
+
+
+def seed_templates():
+    '''
+    Returns the sentences of patterns.TESTS as (words, chemicals) with each
+    expected chemical replaced by an empty slot in words.
+    '''
+    templates = []
+    for index, output, sid, sentence in patterns.TESTS:
+        names = set([x for pattern_id, chems in output for x in chems])
+        words = [None if x in names else x for x in sentence.split()]
+        filler = [x for x in words if x is not None]
+        templates.append((words, filler))
+    return templates
+
+
+def synthetic_sentence(rng, templates, length, chem_density, trigger_density):
+    '''
+    Builds a sentence from a random seed template by filling its chemical
+    slots and inserting words at random positions until it has length
+    words. Inserted words are chemicals with probability chem_density,
+    trigger words with probability trigger_density, and otherwise words of
+    the seed. Returns the sentence and the chemicals in it.
+    '''
+    words, filler = rng.choice(templates)
+    words, chemicals = list(words), []
+    for i, word in enumerate(words):
+        if word is None:
+            words[i] = rng.choice(COMPOUNDS)
+            chemicals.append(words[i])
+    while len(words) < length:
+        r = rng.random()
+        if r < chem_density:
+            word = rng.choice(COMPOUNDS)
+            chemicals.append(word)
+        elif r < chem_density + trigger_density:
+            word = rng.choice(TRIGGERS)
+        else:
+            word = rng.choice(filler)
+        # after the first word so sentences start as the seed does
+        words.insert(rng.randint(1, len(words)), word)
+    return ' '.join(words), sorted(set(chemicals))
+
+
+def synthetic_corpus(count, length=40, chem_density=0.1, trigger_density=0.05,
+                     seed=0):
+    '''
+    Returns count synthetic (sid, sentence, chemicals), see synthetic_sentence
+    '''
+    rng = random.Random(seed)
+    templates = seed_templates()
+    corpus = []
+    for i in range(count):
+        sentence, chemicals = synthetic_sentence(rng, templates, length,
+                                                 chem_density, trigger_density)
+        corpus.append(('synthetic-%i' % i, sentence, chemicals))
+    return corpus
+
+
+def percentile(values, p):
+    '''Returns the nearest rank p-th percentile of sorted values'''
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def latency_row(name, times):
+    '''Returns [name, count, p50, p95, p99] with times in microseconds'''
+    times = sorted(times)
+    return [name, len(times)] + [percentile(times, p) * 1e6
+                                 for p in [50, 95, 99]]
+
+
+def bench_extract(count=2000, length=40, chem_density=0.1,
+                  trigger_density=0.05):
+    '''
+    Runs patterns.extract over a synthetic corpus with a local stand-in for
+    chemtagger.get_compounds, so nothing is fetched or cached. Prints the
+    throughput and per-sentence latency percentiles of extract, then of each
+    stage from a second, profiled pass.
+    '''
+    corpus = synthetic_corpus(count, length, chem_density, trigger_density)
+    compounds = dict([(sid, chemicals) for sid, sentence, chemicals in corpus])
+    get_compounds = chemtagger.get_compounds
+    chemtagger.get_compounds = lambda sid, sentence: list(compounds[sid])
+    try:
+        # warms the stem cache so both passes see the same state
+        for sid, sentence, chemicals in corpus:
+            patterns.extract(sid, sentence)
+        times = []
+        began = time.time()
+        for sid, sentence, chemicals in corpus:
+            start = time.time()
+            patterns.extract(sid, sentence)
+            times.append(time.time() - start)
+        elapsed = time.time() - began
+        stage_times = {}
+        patterns.enable_profiling()
+        for sid, sentence, chemicals in corpus:
+            before = dict([(name, list(stats)) for name, stats
+                           in patterns.PROFILE_STATS.items()])
+            patterns.extract(sid, sentence)
+            for name, (calls, matches, seconds) in patterns.PROFILE_STATS.items():
+                # per pattern stats are left to evaluate.py profile
+                if ' ' in name:
+                    continue
+                calls_before, matches_before, seconds_before = before.get(
+                    name, [0, 0, 0.0])
+                if calls != calls_before:
+                    stage_times.setdefault(name, []).append(
+                        seconds - seconds_before)
+        patterns.enable_profiling(False)
+    finally:
+        chemtagger.get_compounds = get_compounds
+    print '%i sentences of %i words, %.2f chemical and %.2f trigger density' % (
+        count, length, chem_density, trigger_density)
+    print '%.1f sentences/sec' % (count / elapsed)
+    table = [latency_row('extract', times)]
+    for name in sorted(stage_times, key=lambda x: -sum(stage_times[x])):
+        table.append(latency_row(name, stage_times[name]))
+    print tabulate(table, ['Stage', 'Sentences', 'p50 (us)', 'p95 (us)',
+                           'p99 (us)'], tablefmt='simple')
+
+
+def bench_tagging(count=400, delay=0.02):
+    '''
+    Tags the same synthetic sentences one at a time with get_compounds and
+    through get_compounds_many against a local stand-in tagger that takes
+    delay seconds per sentence. Results are not kept in the chemtagger store.
+    '''
+    corpus = synthetic_corpus(count)
+    server = chemtagger_server.start(compounds=COMPOUNDS, delay=delay)
+    url, maps = chemtagger.URL, (chemtagger.TAG_MAP, chemtagger.SID_MAP,
+                                 chemtagger.CHEMTAGGER_MAP)
+    chemtagger.URL = 'http://localhost:%i/tag' % server.server_address[1]
+    table = []
+    try:
+        for workers in [1, 4, 16]:
+            chemtagger.TAG_MAP, chemtagger.SID_MAP = {}, {}
+            chemtagger.CHEMTAGGER_MAP = {}
+            pairs = [(sid, sentence) for sid, sentence, chemicals in corpus]
+            began = time.time()
+            if workers == 1:
+                tagged = [(sid, chemtagger.get_compounds(sid, sentence))
+                          for sid, sentence in pairs]
+            else:
+                tagged = list(chemtagger.get_compounds_many(pairs, workers))
+            elapsed = time.time() - began
+            for (sid, compounds), (x, y, chemicals) in zip(tagged, corpus):
+                assert sorted(set(compounds)) == chemicals
+            table.append([workers, count / elapsed])
+    finally:
+        chemtagger.URL = url
+        chemtagger.TAG_MAP, chemtagger.SID_MAP, chemtagger.CHEMTAGGER_MAP = maps
+        # drops the kept alive connections so the server threads can exit
+        chemtagger.SESSION.close()
+        server.shutdown()
+    print 'Stand-in tagger with %i ms per sentence' % (delay * 1000)
+    print tabulate(table, ['Workers', 'Sentences/sec'], tablefmt='simple')
+
+
+def bench_batching(count=800, delay=0.02, sentence_delay=0.002):
+    '''
+    Tags synthetic sentences through get_compounds_many with growing batch
+    sizes against a local stand-in tagger that takes delay seconds per
+    request plus sentence_delay per sentence, and checks every batch size
+    finds the same compounds.
+    '''
+    corpus = synthetic_corpus(count, seed=1)
+    pairs = [(sid, sentence) for sid, sentence, chemicals in corpus]
+    server = chemtagger_server.start(compounds=COMPOUNDS, delay=delay,
+                                     sentence_delay=sentence_delay)
+    url, maps = chemtagger.URL, (chemtagger.TAG_MAP, chemtagger.SID_MAP,
+                                 chemtagger.CHEMTAGGER_MAP)
+    chemtagger.URL = 'http://localhost:%i/tag' % server.server_address[1]
+    table, expected = [], None
+    try:
+        for batch_size in [1, 4, 16, 64]:
+            chemtagger.TAG_MAP, chemtagger.SID_MAP = {}, {}
+            chemtagger.CHEMTAGGER_MAP = {}
+            chemtagger.BATCH_STATS.update(batches=0, fallbacks=0,
+                                          sentences=0)
+            began = time.time()
+            tagged = list(chemtagger.get_compounds_many(pairs, 16, batch_size))
+            elapsed = time.time() - began
+            if expected is None:
+                expected = tagged
+            assert tagged == expected
+            table.append([batch_size, count / elapsed,
+                          chemtagger.BATCH_STATS['batches'],
+                          chemtagger.BATCH_STATS['fallbacks'],
+                          chemtagger.BATCH_STATS['sentences']])
+    finally:
+        chemtagger.URL = url
+        chemtagger.TAG_MAP, chemtagger.SID_MAP, chemtagger.CHEMTAGGER_MAP = maps
+        # drops the kept alive connections so the server threads can exit
+        chemtagger.SESSION.close()
+        server.shutdown()
+    print 'Stand-in tagger with %i ms per request and %i ms per sentence' % (
+        delay * 1000, sentence_delay * 1000)
+    print tabulate(table, ['Batch size', 'Sentences/sec', 'Batches',
+                           'Fallbacks', 'Sent'], tablefmt='simple')
+
+
+def bench_parsing(repeat=5):
+    '''
+    Compares building the xmltodict tree and walking it with parse_tree to
+    chemtagger.oscar_compounds on stand-in tagger responses of growing size.
+    '''
+    rng = random.Random(0)
+    compounds = set([tuple(x.split()) for x in chemtagger_server.COMPOUNDS])
+    longest = max([len(x) for x in compounds])
+    table = []
+    for words in [50, 500, 5000, 50000]:
+        text = ' '.join(rng.choice(FILLER + chemtagger_server.COMPOUNDS)
+                        for i in range(words))
+        xml = chemtagger_server.tag_xml(text, compounds, longest)
+
+        def tree(xml):
+            result = []
+            chemtagger.parse_tree(chemtagger.parse_xml(xml), result)
+            return result
+        assert tree(xml) == chemtagger.oscar_compounds(xml)
+        tree_time = best_of(tree, [xml], repeat)
+        stream_time = best_of(chemtagger.oscar_compounds, [xml], repeat)
+        table.append([words, len(xml), tree_time * 1000, stream_time * 1000,
+                      tree_time / stream_time])
+    print tabulate(table, ['Words', 'Bytes', 'xmltodict (ms)', 'Streaming (ms)',
+                           'Speedup'], tablefmt='simple')
+
+
+# element names of random_xml, mostly those of tagger responses
+XML_NAMES = ['Sentence', 'NounPhrase', 'OSCAR-CM', 'MOLECULE', 'VB', 'DT']
+XML_TEXT = ['atp', 'nad+', 'coenzyme', ' ', '  a ', '&amp;', '&lt;b', 'x.y', '']
+
+
+def random_xml(rng, depth=0):
+    '''
+    Generates a random tagger-like document: nested elements with repeated
+    and interleaved names, mixed text and entities, and OSCAR-CM elements
+    that are sometimes irregular, holding attributes, elements or no text.
+    About one in twenty is cut short, so it is malformed.
+    '''
+    def element(depth):
+        name = rng.choice(XML_NAMES)
+        attrs = ' id="%i"' % rng.randint(0, 9) if rng.random() < 0.05 else ''
+        if name == 'OSCAR-CM' and rng.random() < 0.9:
+            inner = rng.choice(XML_TEXT[:-1])
+        elif depth < 4:
+            inner = ''.join(rng.choice([element, lambda x: rng.choice(
+                XML_TEXT)])(depth + 1) for i in range(rng.randint(0, 5)))
+        else:
+            inner = rng.choice(XML_TEXT)
+        return '<%s%s>%s</%s>' % (name, attrs, inner, name)
+    xml = '<Document>%s</Document>' % ''.join(
+        element(1) for i in range(rng.randint(0, 6)))
+    if rng.random() < 0.05:
+        xml = xml[:rng.randint(0, len(xml))]
+    return xml
+
+
+def check_parsing(count=30000, seed=0):
+    '''
+    Checks chemtagger.oscar_compounds finds the same compounds as walking
+    the xmltodict tree with parse_tree, or raises the same error, on count
+    random documents.
+    '''
+    def outcome(func, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            return type(e)
+
+    def tree(xml):
+        compounds = []
+        chemtagger.parse_tree(chemtagger.parse_xml(xml), compounds)
+        return compounds
+    rng = random.Random(seed)
+    for i in range(count):
+        xml = random_xml(rng)
+        expected = outcome(tree, xml)
+        found = outcome(chemtagger.oscar_compounds, xml)
+        assert found == expected, (xml, found, expected)
+    print 'oscar_compounds matched parse_tree on %i documents' % count
+
+
+def regex_matches(tokens, chemicals):
+    '''Returns the matches of the regex engine as extract expands them'''
+    tagged = patterns.tag_chemicals(' '.join(tokens), chemicals)
+    matched = patterns.match_patterns(patterns.group_list(tagged))
+    return [(pattern_id, match) for pattern_id, groups in matched
+            for match in patterns.expand_chems(groups)]
+
+
+def check_engines(count=5000, seed=0):
+    '''
+    Checks patterns.match_tokens returns the same matches as the regex
+    engine on count synthetic sentences. Some chemical names and words
+    contain the $ and braces of the tags, see patterns.sanitize_chemicals.
+    '''
+    rng = random.Random(seed)
+    templates = seed_templates()
+    markers = ['us$', '$5', 'a$b', '{x}', '}chem_list', 'c$ d']
+    for i in range(count):
+        sentence, chemicals = synthetic_sentence(
+            rng, templates, rng.choice([10, 20, 40]), 0.15, 0.1)
+        words = sentence.split()
+        for j in range(rng.randint(0, 2)):
+            marker = rng.choice(markers)
+            words.insert(rng.randint(1, len(words)), marker)
+            if rng.random() < 0.5:
+                chemicals.append(marker)
+        sentence = ' '.join(words)
+        chemicals = patterns.sanitize_chemicals(chemicals)
+        tokens = patterns.stem_sentence(sentence, chemicals)
+        expected = regex_matches(tokens, chemicals)
+        found = patterns.match_tokens(tokens, chemicals)
+        assert found == expected, (sentence, chemicals, found, expected)
+    print 'match_tokens matched the regex engine on %i sentences' % count
+
+
+def bench_imports(modules=['patterns', 'chemtagger', 'smiles_map',
+                           'evaluate'], repeat=5):
+    '''
+    Times a fresh interpreter importing each module, best of repeat runs,
+    from the current directory so the maps under ../data are found as usual.
+    The first row is an interpreter that imports nothing.
+    '''
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join([here] + filter(
+        None, [env.get('PYTHONPATH')]))
+    table = []
+    for module in [None] + modules:
+        code = 'import %s' % module if module else 'pass'
+        times = []
+        for i in range(repeat):
+            began = time.time()
+            subprocess.check_call([sys.executable, '-c', code], env=env,
+                                  stdout=open(os.devnull, 'wb'))
+            times.append(time.time() - began)
+        table.append([module or '(interpreter)', min(times) * 1000])
+    print tabulate(table, ['Module', 'Import (ms)'], tablefmt='simple')
+
+
+def main():
+    '''
+    Benchmarks parts of the extraction pipeline. Everything runs offline.
+    check compares the token engine and the one pass OSCAR-CM parser to
+    the code they replace on random input.
+    '''
+    if len(sys.argv) == 2:
+        this_file, command = sys.argv
+        if command == 'group_list':
+            bench_group_list()
+            return
+        elif command == 'batching':
+            bench_batching()
+            return
+        elif command == 'parsing':
+            bench_parsing()
+            return
+        elif command == 'imports':
+            bench_imports()
+            return
+        elif command == 'check':
+            check_engines()
+            check_parsing()
+            return
+        elif command == 'tagging':
+            bench_tagging()
+            return
+        elif command == 'extract':
+            for length, chem_density, trigger_density in [
+                    (20, 0.1, 0.05), (40, 0.1, 0.05), (40, 0.3, 0.15),
+                    (160, 0.1, 0.05)]:
+                bench_extract(length=length, chem_density=chem_density,
+                              trigger_density=trigger_density)
+                print
+            return
+    print ('Wrong number of arguments. Usage: python benchmark.py '
+           '[group_list, extract, tagging, batching, parsing, imports, '
+           'check]')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,84 @@
-import os
+import sys
+import hashlib
 import requests
+import unicodedata
 import xmltodict
+import gazetteer
+import resilience
 from utils import *
+from xml.parsers import expat
+from sqlite_map import SqliteMap
+from collections import deque
+from multiprocessing.pool import ThreadPool
 try:
     import ujson as json
 except ImportError:
     import json
 
 URL = 'http://pathway.berkeley.edu:27329/tag'
+TIMEOUT = 60  # seconds to wait on the tagger before giving up on a sentence
+WORKERS = 16  # requests in flight at once in get_compounds_many
+# sentences sent per request by get_compounds_many, see tag_batch
+BATCH_SIZE = 1
+BATCH_SEPARATOR = '.\n\n'
+# requests made by tag_batch, Sentence elements that did not line up with
+# the sentences sent and sentences sent in all, counting those sent again
+BATCH_STATS = {'batches': 0, 'fallbacks': 0, 'sentences': 0}
+# error statuses raised by raise_for_status are the tagger failing on the
+# text sent, so they are rejected rather than retried, see request
+TAGGER = resilience.backend('chemtagger',
+                            transient=(requests.RequestException,),
+                            rejected=(requests.HTTPError,), retries=2)
+# statuses a proxy answers when it cannot reach the tagger, which are retried
+UNREACHABLE_STATUSES = (502, 503, 504)
+SESSION = requests.Session()
+SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1,
+                                                       pool_maxsize=WORKERS))
+# where compounds come from: 'remote' asks ChemicalTagger, 'gazetteer' only
+# looks names up in gazetteer.py, and 'union' adds the gazetteer's names to
+# ChemicalTagger's
+MODE = 'remote'
+DB_PATH = '../data/chemtagger.db'
 MAP_PATH = '../data/chemtagger.json'
-if os.path.exists(MAP_PATH):
-    CHEMTAGGER_MAP = json.load(open(MAP_PATH))
-    print 'Loaded existing chemtagger map.'
-else:
-    CHEMTAGGER_MAP = {}
-    print 'No chemtagger map found. Starting from scratch.'
+# tagged compounds by sentence_key, so a sentence is tagged once whatever
+# abstract or split it comes from
+TAG_MAP = SqliteMap(DB_PATH, table='compounds')
+# sentence_key of the sentence last tagged for each sid
+SID_MAP = SqliteMap(DB_PATH, table='sids')
+# compounds by sid from before entries were keyed by sentence, created from
+# the older MAP_PATH dump if missing and emptied by rekey. Lookups by sentence
+# do not read it, as a sid may name another sentence since a re-split
+CHEMTAGGER_MAP = SqliteMap(DB_PATH, MAP_PATH)
 
 
-def get_tree(text):
+def fetch(text):
+    '''
+    Returns the XML ChemicalTagger responds with for text, raising
+    resilience.Unavailable when it cannot be reached, see TAGGER.
+    '''
+    return TAGGER.call(request, text)
+
+
+def request(text):
     data = {'paper': text}
     headers = {'Content-type': 'application/json'}
-    result = requests.get(URL, data=json.dumps(data), headers=headers)
+    result = SESSION.get(URL, data=json.dumps(data), headers=headers,
+                         timeout=TIMEOUT)
+    if result.status_code in UNREACHABLE_STATUSES:
+        raise requests.ConnectionError('%i %s' % (result.status_code,
+                                                  result.reason),
+                                       response=result)
+    result.raise_for_status()
+    return result.text
+
+
+def get_tree(text):
+    return xmltodict.parse(fetch(text))
+
+
+def parse_xml(xml):
     try:
-        return xmltodict.parse(result.text)
+        return xmltodict.parse(xml)
     except Exception:
         return []
 
@@ -42,21 +98,380 @@ def parse_tree(tree, compounds):
                 parse_tree(tree[key], compounds)
 
 
-def get_compounds(sid, sentence):
-    if sid in CHEMTAGGER_MAP:
-        return CHEMTAGGER_MAP[sid]
-    tree = get_tree(sentence)
-    cmps = []
-    parse_tree(tree, cmps)
-    CHEMTAGGER_MAP[sid] = cmps
+class IrregularCompound(Exception):
+    '''An OSCAR-CM element that is not plain text, see oscar_compounds'''
+    pass
+
+
+def oscar_compounds(xml):
+    '''
+    Returns the same compounds as parse_tree on the xmltodict tree of xml,
+    in one expat pass that keeps only the compounds found so far. Like
+    xmltodict, same named children are visited together in the order their
+    name first appears, and sibling OSCAR-CM texts are joined by a space.
+    Responses with an OSCAR-CM element holding attributes, elements or no
+    text fall back to building the tree.
+    '''
+    try:
+        return scan_compounds(xml)
+    except IrregularCompound:
+        compounds = []
+        parse_tree(parse_xml(xml), compounds)
+        return compounds
+    except Exception:
+        return []
+
+
+def sentence_compounds(xml):
+    '''
+    Returns (compounds, text) of each Sentence element of xml in document
+    order, or None when some compounds are outside a single Sentence or the
+    response cannot be read, see oscar_compounds.
+    '''
+    sentences = []
+    try:
+        compounds = scan_compounds(xml, sentences)
+    except Exception:
+        return None
+    if sum([len(x) for x, text in sentences]) != len(compounds):
+        return None
+    return sentences
+
+
+def scan_compounds(xml, sentences=None):
+    '''
+    Does the expat pass of oscar_compounds, raising IrregularCompound where
+    it needs the tree. When sentences is given, the compounds and text of
+    each Sentence element are appended to it.
+    '''
+    # each open element is [name, child names in first seen order,
+    # name -> compounds or OSCAR-CM texts, text]
+    stack = [[None, [], {}, []]]
+    text = []
+
+    def start(name, attrs):
+        if stack[-1][0] == 'OSCAR-CM' or (name == 'OSCAR-CM' and attrs):
+            raise IrregularCompound()
+        stack.append([name, [], {}, []])
+        if name == 'Sentence':
+            del text[:]
+
+    def end(name):
+        name, order, groups, data = stack.pop()
+        if name == 'OSCAR-CM':
+            value = ''.join(data).strip()
+            if not value:
+                raise IrregularCompound()
+        else:
+            value = compounds_of(order, groups)
+            if name == 'Sentence' and sentences is not None:
+                sentences.append((value, ''.join(text)))
+        parent = stack[-1]
+        if name not in parent[2]:
+            parent[1].append(name)
+            parent[2][name] = [value]
+        else:
+            parent[2][name].append(value)
+
+    def characters(data):
+        if stack[-1][0] == 'OSCAR-CM':
+            stack[-1][3].append(data)
+        if sentences is not None:
+            text.append(data)
+
+    encoding = None
+    if isinstance(xml, unicode):
+        xml, encoding = xml.encode('utf-8'), 'utf-8'
+    parser = expat.ParserCreate(encoding, None)
+    parser.ordered_attributes = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = characters
+    parser.buffer_text = True
+    # entities are left unexpanded, as in xmltodict
+    parser.DefaultHandler = lambda x: None
+    parser.ExternalEntityRefHandler = lambda *x: 1
+    parser.Parse(xml, True)
+    return compounds_of(stack[0][1], stack[0][2])
+
+
+def compounds_of(order, groups):
+    '''Returns the compounds of an element from its children's'''
+    compounds = []
+    for name in order:
+        if name == 'OSCAR-CM':
+            texts = groups[name]
+            compounds.append(texts[0] if len(texts) == 1 else ' '.join(texts))
+        else:
+            for child in groups[name]:
+                compounds.extend(child)
+    return compounds
+
+
+def sentence_key(sentence):
+    '''
+    Returns the cache key of a sentence, a hash of its text with unicode
+    normalized and whitespace collapsed to single spaces.
+    '''
+    if isinstance(sentence, str):
+        sentence = sentence.decode('utf-8')
+    text = ' '.join(unicodedata.normalize('NFC', sentence).split())
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def cached_compounds(sid, key):
+    '''
+    Returns the cached compounds of the sentence with the given key, or None,
+    and points sid at the sentence.
+    '''
+    cmps = TAG_MAP.get(key)
+    if cmps is not None and SID_MAP.get(sid) != key:
+        SID_MAP[sid] = key
     return cmps
 
 
+def cache_compounds(sid, key, cmps):
+    TAG_MAP[key] = cmps
+    SID_MAP[sid] = key
+
+
+def get_cached(sid):
+    '''Returns the compounds last tagged for sid, or None'''
+    key = SID_MAP.get(sid)
+    if key is None:
+        return CHEMTAGGER_MAP.get(sid)
+    return TAG_MAP.get(key)
+
+
+def get_compounds(sid, sentence):
+    '''
+    Returns the compounds in sentence, or None when ChemicalTagger cannot be
+    reached, which is not cached so the sentence is tagged again next time.
+    '''
+    if MODE == 'gazetteer':
+        return gazetteer.find(sentence)
+    key = sentence_key(sentence)
+    cmps = cached_compounds(sid, key)
+    if cmps is None:
+        try:
+            cmps = tag(sentence)
+        except resilience.Unavailable:
+            return with_gazetteer(sentence, None)
+        cache_compounds(sid, key, cmps)
+    return with_gazetteer(sentence, cmps)
+
+
+def with_gazetteer(sentence, cmps):
+    '''
+    Adds the compounds gazetteer finds in sentence to ChemicalTagger's when
+    MODE is 'union', or returns the gazetteer's alone when ChemicalTagger's
+    are None. Only ChemicalTagger's are cached.
+    '''
+    if MODE != 'union':
+        return cmps
+    if cmps is None:
+        return gazetteer.find(sentence)
+    return cmps + [x for x in gazetteer.find(sentence) if x not in cmps]
+
+
+def tag(sentence):
+    '''Returns the compounds ChemicalTagger finds in sentence, uncached'''
+    return oscar_compounds(fetch(sentence))
+
+
+def tag_batch(sentences):
+    '''
+    Returns the compounds of each sentence, or None for those that could not
+    be tagged, tagging them in one request with each sentence ended by
+    BATCH_SEPARATOR. The tagger has to return one Sentence element per
+    sentence with the same text, ignoring whitespace. Where it joins
+    sentences into one element, or splits one into several, just those
+    sentences are tagged again on their own, see align. Where the texts do
+    not line up at all, or the request fails, the sentences before are kept
+    and the rest are tagged one at a time, see tag_each.
+    '''
+    BATCH_STATS['sentences'] += len(sentences)
+    if len(sentences) == 1:
+        return tag_each(sentences)
+    BATCH_STATS['batches'] += 1
+    try:
+        result = sentence_compounds(fetch(''.join(
+            [x + BATCH_SEPARATOR for x in sentences]))) or []
+    except resilience.Unavailable:
+        result = []
+    texts = [squeeze(text) for cmps, text in result]
+    expected = [squeeze(x + BATCH_SEPARATOR) for x in sentences]
+    compounds = []
+    i = 0  # Sentence elements used so far
+    while len(compounds) < len(sentences):
+        j = len(compounds)
+        aligned = align(texts, i, expected, j)
+        if aligned is None:
+            BATCH_STATS['fallbacks'] += 1
+            BATCH_STATS['sentences'] += len(sentences) - j
+            return compounds + tag_each(sentences[j:])
+        elements, count = aligned
+        if elements == count == 1:
+            compounds.append(result[i][0])
+        else:
+            BATCH_STATS['fallbacks'] += 1
+            BATCH_STATS['sentences'] += count
+            compounds += tag_each(sentences[j:j + count])
+        i += elements
+    return compounds
+
+
+def tag_each(sentences):
+    '''
+    Returns the compounds of each sentence, tagged one request per sentence,
+    or None for those that could not be tagged, so one sentence the tagger
+    rejects loses only its own compounds.
+    '''
+    compounds = []
+    for sentence in sentences:
+        try:
+            compounds.append(tag(sentence))
+        except resilience.Unavailable:
+            compounds.append(None)
+    return compounds
+
+
+def align(texts, i, expected, j):
+    '''
+    Returns how many Sentence texts from texts[i] and sentences from
+    expected[j] line up, as (elements, sentences): (1, 1) for a match,
+    (1, k) when the tagger joined k sentences, as it does when one starts
+    lowercase, and (k, 1) when it split one. Returns None when they do not.
+    '''
+    if i == len(texts):
+        return None
+    if texts[i] == expected[j]:
+        return 1, 1
+    joined = expected[j]
+    for k in range(j + 1, len(expected)):
+        joined += expected[k]
+        if joined == texts[i]:
+            return 1, k - j + 1
+        if len(joined) >= len(texts[i]):
+            break
+    joined = texts[i]
+    for k in range(i + 1, len(texts)):
+        joined += texts[k]
+        if joined == expected[j]:
+            return k - i + 1, 1
+        if len(joined) >= len(expected[j]):
+            break
+    return None
+
+
+def squeeze(text):
+    return ''.join(text.split())
+
+
+def get_compounds_many(pairs, workers=WORKERS, batch_size=None):
+    '''
+    Generates (sid, compounds) for each (sid, sentence) in pairs, in order.
+    Sentences not in the cache are tagged batch_size at a time, defaulting to
+    BATCH_SIZE, by up to workers threads sharing SESSION's connections. At
+    most workers * batch_size * 4 sentences are read ahead of the one being
+    returned, so pairs can be a long iterator. With MODE 'gazetteer' nothing
+    is sent to ChemicalTagger. Compounds are None for sentences that could
+    not be tagged, as in get_compounds.
+    '''
+    if MODE == 'gazetteer':
+        for sid, sentence in pairs:
+            yield sid, gazetteer.find(sentence)
+        return
+    batch_size = batch_size or BATCH_SIZE
+    pool = ThreadPool(workers)
+    pending = deque()
+    batch = []
+    try:
+        for sid, sentence in pairs:
+            key = sentence_key(sentence)
+            entry = [sid, key, cached_compounds(sid, key), sentence]
+            if entry[2] is None:
+                batch.append((entry, sentence))
+                if len(batch) == batch_size:
+                    submit(pool, batch)
+                    batch = []
+            pending.append(entry)
+            while len(pending) > workers * batch_size * 4 or (
+                    pending and isinstance(pending[0][2], list)):
+                if pending[0][2] is None:
+                    submit(pool, batch)
+                    batch = []
+                yield finish(*pending.popleft())
+        if batch:
+            submit(pool, batch)
+        while pending:
+            yield finish(*pending.popleft())
+    finally:
+        pool.terminate()
+
+
+def submit(pool, batch):
+    '''Starts tagging a batch of ([sid, key, None, sentence], sentence)'''
+    result = pool.apply_async(tag_batch, ([x for entry, x in batch],))
+    for index, (entry, sentence) in enumerate(batch):
+        entry[2] = (result, index)
+
+
+def finish(sid, key, cmps, sentence):
+    '''Waits for a tagging result of get_compounds_many and caches it'''
+    if not isinstance(cmps, list):
+        result, index = cmps
+        cmps = result.get()[index]
+        if cmps is None:
+            return sid, with_gazetteer(sentence, None)
+        cache_compounds(sid, key, cmps)
+    return sid, with_gazetteer(sentence, cmps)
+
+
+def rekey(sentences):
+    '''
+    Moves the entries of CHEMTAGGER_MAP whose sid is in sentences, a dict of
+    sid to sentence, into TAG_MAP keyed by sentence. Returns the number moved.
+    sentences has to be the split the old entries were tagged from, as sids
+    are reused for other sentences when abstracts are split again. Sids
+    tagged since by sentence keep the sentence SID_MAP points them at.
+    '''
+    moved = [(sid, sentence_key(sentences[sid]), cmps)
+             for sid, cmps in CHEMTAGGER_MAP.iteritems() if sid in sentences]
+    TAG_MAP.update((key, cmps) for sid, key, cmps in moved)
+    SID_MAP.update((sid, key) for sid, key, cmps in moved
+                   if sid not in SID_MAP)
+    CHEMTAGGER_MAP.delete(sid for sid, key, cmps in moved)
+    return len(moved)
+
+
+def preload():
+    '''Opens the tag store and gazetteer now rather than on first use'''
+    if MODE != 'remote':
+        gazetteer.load()
+    if MODE == 'gazetteer':
+        return
+    for store in [TAG_MAP, SID_MAP, CHEMTAGGER_MAP]:
+        store.connect()
+
+
 def save_map():
-    json.dump(CHEMTAGGER_MAP, open(MAP_PATH, 'wb'))
+    '''
+    Entries are written to DB_PATH as they are tagged, this only compacts
+    the database's write-ahead log at the end of a run.
+    '''
+    TAG_MAP.checkpoint()
     print 'Chemtagger map saved successfully.'
 
 
+def export_map(path=MAP_PATH):
+    '''Dumps compounds by sid to a JSON file in the older MAP_PATH format'''
+    result = dict(CHEMTAGGER_MAP.iteritems())
+    for sid, key in SID_MAP.iteritems():
+        result[sid] = TAG_MAP[key]
+    json.dump(result, open(path, 'wb'))
+
+
 def main():
     tests = [
         "Aminoimidazole ribonucleotide (AIR) synthetase (PurM) catalyzes the conversion of formylglycinamide ribonucleotide (FGAM) and ATP to AIR, ADP, and P(i), the fifth step in de novo purine biosynthesis",
@@ -69,6 +484,12 @@ def main():
         "Therefore, the data provide firm evidence for the concept that delta\"mu Na+ is the primary driving force for the synthesis of ATP in P. modestum",
         "S-Ribosylhomocysteinase (LuxS) catalyzes the cleavage of the thioether linkage in S-ribosylhomocysteine (SRH) to produce homocysteine (Hcys) and 4,5-dihydroxy-2,3-pentanedione (DPD), the precursor of type II bacterial autoinducer (AI-2)",
     ]
+    if len(sys.argv) == 3 and sys.argv[1] == 'rekey':
+        # the sentences file CHEMTAGGER_MAP was tagged from, see rekey
+        sentences = json.load(open(sys.argv[2]))
+        print 'Rekeyed %i entries by sentence' % rekey(sentences)
+        save_map()
+        return
     for test in tests:
         print get_compounds(test)
 
@@ -0,0 +1,137 @@
+import sys
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from xml.sax.saxutils import escape
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# compounds the stand-in tags when none are given
+COMPOUNDS = ['glucose', 'fructose', 'ATP', 'ADP', 'NADH', 'NAD+', 'pyruvate',
+             'L-lactate', 'acetyl-CoA', 'coenzyme A', 'citrate', 'acetate',
+             'oxaloacetate', 'glutamate', '2-oxoglutarate', 'ammonia', 'water',
+             'CO2', 'serine', 'glycine', 'methionine', 'estrone', 'estradiol']
+
+
+def tag_xml(text, compounds, longest):
+    '''
+    Returns ChemicalTagger style XML for text, marking every occurrence of a
+    compound as an OSCAR-CM element per token. compounds maps the tokens of
+    each compound to itself, and longest is the most tokens in a compound.
+    Sentences are split as in the tagger, see sentences.
+    '''
+    parts = ['<Document>']
+    for sentence in sentences(text.split()):
+        parts.append('<Sentence>')
+        i = 0
+        while i < len(sentence):
+            for size in range(min(longest, len(sentence) - i), 0, -1):
+                if tuple(sentence[i:i + size]) in compounds:
+                    parts.append('<MOLECULE><OSCARCM>')
+                    parts.extend(['<OSCAR-CM>%s</OSCAR-CM>' % escape(x)
+                                  for x in sentence[i:i + size]])
+                    parts.append('</OSCARCM></MOLECULE>')
+                    i += size
+                    break
+            else:
+                if sentence[i] == '.':
+                    parts.append('<STOP>.</STOP>')
+                else:
+                    parts.append('<NN>%s</NN>' % escape(sentence[i]))
+                i += 1
+        parts.append('</Sentence>')
+    parts.append('</Document>')
+    return ''.join(parts)
+
+
+def sentences(words):
+    '''
+    Splits words into sentences after each word ending in a period that is
+    not followed by a lowercase word, so abbreviations like "P. putida" stay
+    in one sentence.
+    '''
+    sentence = []
+    for i, word in enumerate(words):
+        if len(word) > 1 and word.endswith('.'):
+            sentence.extend([word[:-1], '.'])
+        else:
+            sentence.append(word)
+        if word.endswith('.') and not (i + 1 < len(words) and
+                                       words[i + 1][:1].islower()):
+            yield sentence
+            sentence = []
+    if sentence:
+        yield sentence
+
+
+class TagHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Answers GET /tag with a JSON body of {"paper": text} like the tagger'''
+    protocol_version = 'HTTP/1.1'
+    # one write per response, or keep-alive clients stall on delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path != '/tag':
+            self.send_error(404)
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        text = json.loads(self.rfile.read(length))['paper']
+        body = tag_xml(text, self.server.compounds, self.server.longest)
+        if self.server.delay or self.server.sentence_delay:
+            time.sleep(self.server.delay + self.server.sentence_delay *
+                       body.count('<Sentence>'))
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TagServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start(port=0, compounds=COMPOUNDS, delay=0.0, sentence_delay=0.0):
+    '''
+    Starts a stand-in tagger on localhost in a background thread and returns
+    the server. Each request waits delay seconds plus sentence_delay seconds
+    per sentence to mimic the round trip and work of the real tagger. The
+    url to set as chemtagger.URL is
+    'http://localhost:%i/tag' % server.server_address[1].
+    '''
+    server = TagServer(('localhost', port), TagHandler)
+    server.compounds = set([tuple(x.split()) for x in compounds])
+    server.longest = max([len(x) for x in server.compounds] or [1])
+    server.delay = delay
+    server.sentence_delay = sentence_delay
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main():
+    '''
+    Serves the stand-in tagger until interrupted.
+    usage: python chemtagger_server.py [port]
+    '''
+    port = int(sys.argv[1]) if len(sys.argv) == 2 else 27329
+    server = start(port)
+    print 'Serving stand-in tagger on http://localhost:%i/tag' % port
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,25 +8,187 @@ https://github.com/mcs07/CIRpy
 
 
 import os
+import json
 import urllib
 import urllib2
+import httplib
+import urlparse
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from xml.etree import ElementTree as ET
 
 
 API_BASE = 'http://cactus.nci.nih.gov/chemical/structure'
-
-
-def resolve(input, representation, resolvers=None, **kwargs):
+TIMEOUT = 60
+WORKERS = 8  # requests in flight at once in resolve_many
+REDIRECTS = 5
+# what query raises when a request fails or its response can not be read
+ERRORS = (urllib2.URLError, httplib.HTTPException, IOError, ET.ParseError)
+
+# kept alive connections of each thread by (scheme, host)
+_connections = threading.local()
+
+
+class Cache(object):
+    """ Bounded cache of query results shared by every resolve, query and Molecule
+
+    Keeps the maxsize most recently used results in memory, and every result
+    in a SqliteMap at path if one is given, so they outlive the process.
+    Only found results are kept.
+    """
+
+    def __init__(self, maxsize=10000, path=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # guards the store's connection, which every thread shares
+        self.store_lock = threading.Lock()
+        self.store = None
+        if path:
+            from sqlite_map import SqliteMap
+            self.store = SqliteMap(path, table='cir')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = value = self.entries.pop(key)
+                self.hits += 1
+                return value
+        value = None
+        if self.store is not None:
+            # memory hits do not wait on this, only other store reads do
+            with self.store_lock:
+                value = self.store.get(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.pop(key, None)
+            self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self._remember(key, value)
+        if self.store is not None:
+            with self.store_lock:
+                self.store[key] = value
+
+    def _remember(self, key, value):
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+CACHE = Cache()
+
+
+def _cache_key(input, representation, resolvers, kwargs):
+    return json.dumps([input, representation, list(resolvers or []), sorted(kwargs.items())])
+
+
+def resolve(input, representation, resolvers=None, cache=True, **kwargs):
     """ Resolve input to the specified output representation """
-    resultdict = query(input, representation, resolvers, **kwargs)
+    resultdict = query(input, representation, resolvers, cache, **kwargs)
     result = resultdict[0]['value'] if resultdict else None
     if result and len(result) == 1:
         result = result[0]
     return result
 
 
-def query(input, representation, resolvers=None, **kwargs):
-    """ Get all results for resolving input to the specified output representation """
+def resolve_many(inputs, representation, resolvers=None, workers=WORKERS, call=None, **kwargs):
+    """ Resolve each input to the specified output representation, in order
+
+    Requests run on up to workers threads, each keeping its connection alive
+    between requests. The result for an input whose resolve raised is the
+    exception instead, so one failure does not lose the others. call, if
+    given, is used as call(resolve, input, representation, resolvers, ...)
+    to run each resolve, for example to retry it.
+    """
+    call = call or _call
+    pool = ThreadPool(workers)
+    try:
+        def run(input):
+            try:
+                return call(resolve, input, representation, resolvers, **kwargs)
+            except Exception as e:
+                return e
+        return pool.map(run, inputs, chunksize=1)
+    finally:
+        pool.close()
+
+
+def _call(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def urlopen(url):
+    """ Get the body of url, reusing this thread's connection to its host
+
+    Raises urllib2.HTTPError for error statuses like urllib2.urlopen.
+    """
+    for redirect in range(REDIRECTS + 1):
+        response = _request(url)
+        if response.status in (301, 302, 303, 307) and response.getheader('location'):
+            url = urlparse.urljoin(url, response.getheader('location'))
+            continue
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        return response.body
+    raise urllib2.HTTPError(url, response.status, 'Too many redirects', response.msg, None)
+
+
+def _request(url):
+    """ GET url on a kept alive connection, reconnecting once if it went stale """
+    parts = urlparse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    key = (parts.scheme, parts.netloc)
+    if not hasattr(_connections, 'pool'):
+        _connections.pool = {}
+    for attempt in range(2):
+        connection = _connections.pool.get(key)
+        fresh = connection is None
+        if fresh:
+            cls = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+            connection = _connections.pool[key] = cls(parts.netloc, timeout=TIMEOUT)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            response.body = response.read()
+        except (httplib.HTTPException, IOError):
+            connection.close()
+            del _connections.pool[key]
+            # the server may have closed a kept alive connection, so a used
+            # one gets a second try on a new connection
+            if fresh or attempt:
+                raise
+            continue
+        if response.will_close:
+            connection.close()
+            del _connections.pool[key]
+        return response
+
+
+def query(input, representation, resolvers=None, cache=True, **kwargs):
+    """ Get all results for resolving input to the specified output representation
+
+    Results are looked up in CACHE first unless cache is False, which still
+    stores the new result, to refresh it.
+    """
+    key = _cache_key(input, representation, resolvers, kwargs)
+    if cache and CACHE is not None:
+        result = CACHE.get(key)
+        if result is not None:
+            return result
     apiurl = API_BASE+'/%s/%s/xml' % (urllib2.quote(input), representation)
     if resolvers:
         kwargs['resolver'] = ",".join(resolvers)
@@ -34,7 +196,7 @@ def query(input, representation, resolvers=None, **kwargs):
         apiurl+= '?%s' % urllib.urlencode(kwargs)
     result = []
     try:
-        tree = ET.parse(urllib2.urlopen(apiurl))
+        tree = ET.fromstring(urlopen(apiurl))
         for data in tree.findall(".//data"):
             datadict = {'resolver':data.attrib['resolver'],
                         'notation':data.attrib['notation'],
@@ -44,9 +206,13 @@ def query(input, representation, resolvers=None, **kwargs):
             if len(datadict['value']) == 1:
                 datadict['value'] = datadict['value'][0]
             result.append(datadict)
-    except urllib2.HTTPError:
-        # TODO: Proper handling of 404, for now just returns None
-        pass
+    except urllib2.HTTPError as e:
+        # CIR answers 404 for inputs it can not resolve, other errors are
+        # raised so they are not mistaken for a missing structure
+        if e.code != 404:
+            raise
+    if result and CACHE is not None:
+        CACHE.put(key, result)
     return result if result else None
 
 def download(input, filename, format='sdf', overwrite=False, resolvers=None, **kwargs):
@@ -94,6 +260,19 @@ class Molecule(object):
     def __repr__(self):
         return "Molecule(%r, %r)" % (self.input, self.resolvers)
 
+    def prefetch(self, properties=None, workers=WORKERS):
+        """ Resolve several properties at once, all of them by default """
+        properties = [x for x in properties or PROPERTIES if x not in self.__dict__]
+        if not properties:
+            return self
+        pool = ThreadPool(min(workers, len(properties)))
+        try:
+            values = pool.map(lambda x: resolve(self.input, x, self.resolvers, **self.kwargs), properties)
+        finally:
+            pool.close()
+        self.__dict__.update(zip(properties, values))
+        return self
+
     @CacheProperty
     def stdinchi(self): return resolve(self.input, 'stdinchi', self.resolvers, **self.kwargs)
 
@@ -184,3 +363,6 @@ class Molecule(object):
         """ Download the resolved structure as a file """
         download(self.input, filename, format, overwrite, resolvers, **kwargs)
 
+
+# names of the Molecule properties resolved from CIR
+PROPERTIES = sorted(k for k, v in vars(Molecule).items() if isinstance(v, CacheProperty))
@@ -25,7 +25,12 @@ def match_reaction(tagged_reactions, reactants):
     return False
 
 
-def evaluate():
+def evaluate(profile=False):
+    '''
+    Applies the patterns to every training sentence. With profile, the
+    patterns run in this process with timing enabled and a summary of the
+    time spent per stage and per pattern is printed and dumped at the end.
+    '''
     sentences = json.load(open('../data/train_sentences.json'))
     training_set = json.load(open('../data/train_match.json'))
     # Pattern match and subset matches with BRENDA tagged reaction
@@ -40,9 +45,10 @@ def evaluate():
     fn = []
     bar, i = pbar(len(sentences)), 0
     print 'Evaluating patterns'
+    patterns.enable_profiling(profile)
     bar.start()
-    for sid, sentence in sentences.iteritems():
-        reactants = patterns.extract(sid, sentence)
+    for sid, reactants in patterns.extract_many(sentences.iteritems(),
+                                                processes=1 if profile else None):
         if reactants and sid in training_set:
             tagged_reactions = training_set[sid]['reactants'].keys()
             found_match = False
@@ -73,6 +79,13 @@ def evaluate():
               indent=2, sort_keys=True)
     json.dump(sorted(tn), open('../data/evaluate_tn.json', 'wb'), indent=2)
     json.dump(sorted(fn), open('../data/evaluate_fn.json', 'wb'), indent=2)
+    if profile:
+        summary = patterns.profile_summary()
+        print tabulate(summary, ['Stage', 'Calls', 'Matches', 'Seconds',
+                                 'Mean (us)'], tablefmt='simple')
+        print 'Stem cache: %(hits)s hits, %(misses)s misses' % patterns.STEM_STATS
+        json.dump(summary, open('../data/evaluate_profile.json', 'wb'),
+                  indent=2)
 
 
 def stats():
@@ -137,10 +150,14 @@ def main():
             evaluate()
             chemtagger.save_map()
             return
+        elif command == 'profile':
+            evaluate(profile=True)
+            chemtagger.save_map()
+            return
         elif command == 'stats':
             stats()
             return
-    print 'Wrong number of arguments. Usage: python evaluate.py [run, stats]'
+    print 'Wrong number of arguments. Usage: python evaluate.py [run, profile, stats]'
 
 
 if __name__ == '__main__':
@@ -0,0 +1,165 @@
+import os
+import sys
+import parse_utils
+import smiles_map
+import journal_map
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# inchi_map.MAP_PATH, read directly as importing inchi_map loads Indigo
+INCHI_PATH = '../data/inchi_map.json'
+CHEMICALS_PATH = '../data/train_clean_chemicals.json'
+GAZETTEER_PATH = '../data/gazetteer.json'
+# names shorter than this that only come lowercased are too likely to be
+# words, like "no", "in" or "as", and are left out
+MIN_LOWERCASE = 4
+BRACKETS = {'(': ')', '[': ']'}
+
+# lowercased name -> None for names matched in any case, or the set of
+# spellings that have to match exactly, loaded by load on first use
+NAMES = None
+# lowercased first word -> most words in a name starting with it
+LONGEST = None
+
+
+def source_names():
+    '''
+    Generates every name with a structure in the inchi and smiles maps and
+    every training chemical, in the spelling of its source.
+    '''
+    for path in [INCHI_PATH, smiles_map.MAP_PATH]:
+        for name, structure in journal_map.load(path).iteritems():
+            if structure is not None:
+                yield name
+    if os.path.exists(CHEMICALS_PATH):
+        for chem_id, names in json.load(open(CHEMICALS_PATH)).iteritems():
+            for name in names:
+                yield name
+
+
+def build(names):
+    '''
+    Returns the gazetteer of names as a dict of lowercased name to None or
+    exact spellings, see NAMES. Names with capitals match in that spelling
+    only when short, since "NO" is a chemical and "no" is not.
+    '''
+    gazetteer = {}
+    for name in names:
+        name = ' '.join(name.split())
+        if (not name or name in smiles_map.BLACKLIST_COMMON or
+                name.lower() in smiles_map.BLACKLIST_COMMON or
+                parse_utils.isNumber(name)):
+            continue
+        lower = name.lower()
+        if len(name) >= MIN_LOWERCASE:
+            gazetteer[lower] = None
+        elif name != lower:
+            if lower not in gazetteer:
+                gazetteer[lower] = set()
+            if gazetteer[lower] is not None:
+                gazetteer[lower].add(name)
+    return gazetteer
+
+
+def index(gazetteer):
+    '''Returns LONGEST for a gazetteer'''
+    longest = {}
+    for lower in gazetteer:
+        words = lower.split(' ')
+        longest[words[0]] = max(longest.get(words[0], 0), len(words))
+    return longest
+
+
+def load():
+    '''
+    Loads the gazetteer from GAZETTEER_PATH, or builds it from the name maps
+    when there is no saved one. Long running processes can call this up front.
+    '''
+    global NAMES, LONGEST
+    if NAMES is None:
+        if os.path.exists(GAZETTEER_PATH):
+            saved = json.load(open(GAZETTEER_PATH))
+            NAMES = dict((k, None if v is None else set(v))
+                         for k, v in saved.iteritems())
+        else:
+            NAMES = build(source_names())
+        LONGEST = index(NAMES)
+    return NAMES
+
+
+def save():
+    '''Saves the gazetteer built from the name maps to GAZETTEER_PATH'''
+    global NAMES, LONGEST
+    NAMES = build(source_names())
+    LONGEST = index(NAMES)
+    json.dump(dict((k, None if v is None else sorted(v))
+                   for k, v in NAMES.iteritems()),
+              open(GAZETTEER_PATH, 'wb'))
+    print 'Saved %i names to %s' % (len(NAMES), GAZETTEER_PATH)
+
+
+def trim(word):
+    '''
+    Strips the punctuation ChemicalTagger splits off a word, keeping
+    brackets that belong to the name as in "P(i)" or "(2R,3R)-butanediol".
+    '''
+    word = word.rstrip(',;:.')
+    if word[:1] in BRACKETS and word[-1:] == BRACKETS[word[0]]:
+        inner = word[1:-1]
+        if inner.count(word[0]) == inner.count(word[-1]):
+            word = inner
+    elif word[:1] in BRACKETS and (word.count(word[0]) >
+                                   word.count(BRACKETS[word[0]])):
+        word = word[1:]
+    elif word[-1:] in [')', ']']:
+        opening = '(' if word[-1] == ')' else '['
+        if word.count(word[-1]) > word.count(opening):
+            word = word[:-1]
+    return word.rstrip(',;:.')
+
+
+def find(sentence):
+    '''
+    Returns the compounds of sentence in the gazetteer, like chemtagger.tag
+    without the round trip. Names match whole words, longest first, and are
+    returned as spelled in the sentence.
+    '''
+    load()
+    words = [trim(x) for x in sentence.split()]
+    lowered = [x.lower() for x in words]
+    compounds = []
+    i = 0
+    while i < len(words):
+        for size in range(min(LONGEST.get(lowered[i], 0), len(words) - i),
+                          0, -1):
+            lower = ' '.join(lowered[i:i + size])
+            if lower in NAMES:
+                name = ' '.join(words[i:i + size])
+                if NAMES[lower] is None or name in NAMES[lower]:
+                    compounds.append(name)
+                    i += size
+                    break
+        else:
+            i += 1
+    return compounds
+
+
+def main():
+    '''
+    usage: python gazetteer.py build
+           python gazetteer.py <sentence>
+    '''
+    if len(sys.argv) == 2 and sys.argv[1] == 'build':
+        save()
+        return
+    if len(sys.argv) == 2:
+        print find(sys.argv[1])
+        return
+    print ('Wrong number of arguments. Usage: python gazetteer.py '
+           '[build, <sentence>]')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
 import os
 import sys
-import time
 import shlex
 import cirpy
-import urllib2
 import subprocess
 import parse_utils
+import resilience
+import journal_map
+import negative_cache
+import structure_store
 from utils import *
 from random import choice
+from pymongo import Connection
+from bson import json_util
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from indigo.indigo import *
 from indigo.indigo_inchi import *
 try:
@@ -19,15 +25,26 @@ except ImportError:
 INDIGO = Indigo()
 INDIGO_INCHI = IndigoInchi(INDIGO)
 MAP_PATH = '../data/inchi_map.json'
-if os.path.exists(MAP_PATH):
-    CHEM_INCHI_MAP = json.load(open(MAP_PATH))
-    print 'Loaded existing inchi map.'
-else:
-    CHEM_INCHI_MAP = {}
-    print 'No inchi map found. Starting from scratch.'
+# retries and circuit breaker for CIR, shared with smiles_map. Queries skip
+# cirpy.CACHE, as the map is already their cache and updates need fresh ones
+CIR = resilience.backend('cir')
+CHUNK = 1000  # names resolved together in bulk updates
+# when and why names failed to resolve
+MISSES = negative_cache.NegativeCache('inchi')
+# the last chemical generate_map stored, so an interrupted run resumes there
+CHECKPOINT_PATH = '../data/inchi_map_checkpoint.json'
+CHECKPOINT_EVERY = 5000  # chemicals stored between checkpoints
+READ_BATCH = 1000  # chemicals fetched from mongo per round trip
+# chemical name -> inchi, a journal_map.JournalMap loaded by load_map on
+# first use, which writes each new or changed entry to disk as it is set
+CHEM_INCHI_MAP = None
 
 
 def get_canonical_inchi(chem):
+    if CHEM_INCHI_MAP is None:
+        record = structure_store.STORE.get(chem.lower())
+        if record is not None and 'canonical_inchi' in record:
+            return record['canonical_inchi']
     return canonicalize_inchi(get_inchi(chem))
 
 
@@ -71,74 +88,236 @@ def get_inchi(chem):
     Use cirpy if lookup fails and update the map.
     """
     chem = chem.lower()
+    if CHEM_INCHI_MAP is None:
+        # the shared store answers without loading the map in this process.
+        # Once loaded, the map has entries added since the store was built
+        record = structure_store.STORE.get(chem)
+        if record is not None and 'inchi' in record:
+            return record['inchi']
+    load_map()
     if chem in CHEM_INCHI_MAP:
         return CHEM_INCHI_MAP[chem]
+    elif MISSES.fresh(chem):
+        return None  # failed recently, see negative_cache.TTLS
     else:
-        inchi = query_inchi(chem)
+        try:
+            inchi = query_inchi(chem)
+        except negative_cache.LOOKUP_ERRORS as e:
+            # only recorded in MISSES, so asked again once that expires
+            print e
+            MISSES.record(chem, negative_cache.reason(e))
+            return None
+        if inchi is None:
+            MISSES.record(chem, 'missing')
         CHEM_INCHI_MAP[chem] = inchi
         return inchi
 
 
+def load_map():
+    """
+    Returns CHEM_INCHI_MAP, loading it from MAP_PATH and replaying its
+    journal on first use. Long running processes can call this up front.
+    """
+    global CHEM_INCHI_MAP
+    if CHEM_INCHI_MAP is None:
+        CHEM_INCHI_MAP = journal_map.open_map(MAP_PATH, 'inchi')
+    return CHEM_INCHI_MAP
+
+
 def save_map():
-    json.dump(CHEM_INCHI_MAP, open(MAP_PATH, 'wb'))
+    """Syncs the journal of the map, whose entries are already written"""
+    if CHEM_INCHI_MAP is None:
+        return  # never loaded, so nothing changed
+    CHEM_INCHI_MAP.sync()
     print 'Inchi map saved successfully.'
 
 
 def query_inchi(chem):
-    """Returns the stdinchi of the chem via cirpy"""
+    """
+    Returns the stdinchi of the chem via cirpy, or None if CIR has none.
+    Raises resilience.Unavailable when CIR cannot be reached, see CIR.
+    """
     print 'Query for inchi'
-    try:
-        return cirpy.resolve(chem, 'stdinchi')
-    except urllib2.URLError:
-        print 'Sleeping for inchikey'
-        time.sleep(1)
-        query_inchi(chem)
+    return CIR.call(cirpy.resolve, chem, 'stdinchi', cache=False)
 
 
-def generate_map(port=30000):
+def query_inchi_many(chems):
+    """
+    Returns the stdinchi of each chem in order, resolving them concurrently
+    with cirpy.resolve_many. Chems that failed, even after waiting out an
+    open circuit once, get the exception instead, see negative_cache.reason.
+    """
+    return resilience.retry_refused(CIR, lambda x: cirpy.resolve_many(
+        x, 'stdinchi', call=CIR.call, cache=False), chems)
+
+
+def add_inchis(chems):
+    """
+    Resolves the chems missing from CHEM_INCHI_MAP together and adds them,
+    leaving out those that failed recently, see MISSES.
+    """
+    load_map()
+    chems = sorted([x for x in set([x.lower() for x in chems])
+                    if x not in CHEM_INCHI_MAP and not MISSES.fresh(x)])
+    misses = []
+    for chem, inchi in zip(chems, query_inchi_many(chems)):
+        why = negative_cache.reason(inchi)
+        if why is not None:
+            misses.append((chem, why))
+        if why is None or why == 'missing':
+            CHEM_INCHI_MAP[chem] = inchi
+    MISSES.record_many(misses)
+
+
+def generate_map(port=30000, chemicals=None, workers=cirpy.WORKERS):
     """
     Generates or adds to an existing map by walking through a chemical db.
 
     If a chemical already exists in the map, cirpy.resolve is not called.
+    A thread reads chemicals in _id order while workers resolve the names
+    not seen before. Chemicals are stored in order, and every
+    CHECKPOINT_EVERY of them the map is saved along with the last _id, so
+    an interrupted run starts again after it. chemicals is the collection
+    to read, by default the one on pathway.berkeley.edu, and can be a
+    mongo_stand_in.Collection.
     """
-    try:
+    if chemicals is None:
         chemicals = Connection(
             'pathway.berkeley.edu', port).actv01['chemicals']
-        chem_iter = chemicals.find(timeout=False)
-        bar, i = pbar(chemicals.find().count()), 0
-        bar.start()
-        for chem in chem_iter:
-            for name in parse_utils.grab_names(chem['names']):
-                get_inchi(name)
-            i += 1
-            bar.update(i)
+    load_map()
+    last_id, done = load_checkpoint()
+    bar = pbar(max(chemicals.count(), done))
+    bar.start()
+    bar.update(done)
+    pool = ThreadPool(workers)
+    pending = deque()  # (_id, names) of chemicals read but not stored
+    resolving = {}  # name -> result of its resolve_inchi
+    reader = read_ahead(read_chemicals(chemicals, last_id), READ_BATCH)
+    try:
+        for chem_id, names in reader:
+            for name in names:
+                if name not in resolving and unseen(name):
+                    resolving[name] = pool.apply_async(resolve_inchi, (name,))
+            pending.append((chem_id, names))
+            while len(pending) > workers * 64 or (
+                    pending and all([resolving[x].ready()
+                                     for x in pending[0][1]
+                                     if x in resolving])):
+                last_id = store_chemical(pending.popleft(), resolving)
+                done += 1
+                bar.update(done)
+                if done % CHECKPOINT_EVERY == 0:
+                    save_checkpoint(last_id, done)
+        while pending:
+            last_id = store_chemical(pending.popleft(), resolving)
+            done += 1
+            bar.update(done)
         bar.finish()
         save_map()
-    except Exception as e:
+        if os.path.exists(CHECKPOINT_PATH):
+            os.remove(CHECKPOINT_PATH)
+    except (Exception, KeyboardInterrupt) as e:
         print e
-        save_map()
+        save_checkpoint(last_id, done)
+        print 'Stopped after %i chemicals, run again to resume' % done
+    finally:
+        reader.close()
+        pool.terminate()
+    resilience.report()
 
 
-def verify_map():
+def read_chemicals(chemicals, after=None):
     """
-    Randomly selects entries from inchi map and checks if it is valid.
+    Generates (_id, names) of each chemical after the _id after, in _id
+    order, with names lowercased and without duplicates.
+    """
+    spec = {'_id': {'$gt': after}} if after is not None else {}
+    cursor = chemicals.find(spec, {'names': 1}, timeout=False)
+    try:
+        for chem in cursor.sort('_id', 1).batch_size(READ_BATCH):
+            names = parse_utils.grab_names(chem.get('names', {}))
+            yield chem['_id'], sorted(set([x.lower() for x in names]))
+    finally:
+        # the cursor never times out on the server, so it is closed here
+        cursor.close()
+
+
+def unseen(chem):
+    """Returns whether chem is in neither map nor failed recently"""
+    if chem in CHEM_INCHI_MAP:
+        return False
+    record = structure_store.STORE.get(chem)
+    if record is not None and 'inchi' in record:
+        return False
+    return not MISSES.fresh(chem)
+
+
+def resolve_inchi(chem):
+    """
+    Returns the stdinchi of the chem or the exception it failed with, see
+    negative_cache.reason, waiting out an open circuit once.
+    """
+    for attempt in range(2):
+        try:
+            return CIR.call(cirpy.resolve, chem, 'stdinchi', cache=False)
+        except resilience.CircuitOpen as e:
+            if attempt:
+                return e
+            CIR.wait()
+        except negative_cache.LOOKUP_ERRORS as e:
+            return e
+
+
+def store_chemical(chemical, resolving):
+    """
+    Adds the inchis resolved for a chemical's names to the map and returns
+    its _id. Names are only stored once, with the first chemical they are in.
+    """
+    chem_id, names = chemical
+    misses = []
+    for name in names:
+        if name not in resolving:
+            continue
+        inchi = resolving.pop(name).get()
+        why = negative_cache.reason(inchi)
+        if why is not None:
+            misses.append((name, why))
+        if why is None or why == 'missing':
+            CHEM_INCHI_MAP[name] = inchi
+    MISSES.record_many(misses)
+    return chem_id
+
+
+def load_checkpoint():
+    """Returns the last _id stored by an interrupted generate_map and count"""
+    if not os.path.exists(CHECKPOINT_PATH):
+        return None, 0
+    checkpoint = json_util.loads(open(CHECKPOINT_PATH).read())
+    print 'Resuming after chemical %s' % checkpoint['last_id']
+    return checkpoint['last_id'], checkpoint['done']
+
+
+def save_checkpoint(last_id, done):
+    """Saves the map, then the last _id whose names are in it"""
+    save_map()
+    with open(CHECKPOINT_PATH + '.tmp', 'wb') as f:
+        f.write(json_util.dumps({'last_id': last_id, 'done': done}))
+    os.rename(CHECKPOINT_PATH + '.tmp', CHECKPOINT_PATH)
+
+
+def verify_map(sample_size=2000, margin=0.02, confidence=0.95):
+    """
+    Estimates the share of entries in the inchi map that are out of date.
 
     This is a tool to verify the correctness of the map and estimate
     whether it needs to be updated via update_map().
+    A uniform sample of sample_size names is re-resolved concurrently until
+    the stale share is known to within margin, see utils.verify_sample.
+    Prints and returns a report of the estimate.
     This method does not modify the map in any way.
     """
-    inchi_map = CHEM_INCHI_MAP.items()
-    i, j = 0, 0
-    while True:
-        name, inchi = choice(inchi_map)
-        actual_inchi = query_inchi(name)
-        if actual_inchi != inchi:
-            j += 1
-            data = (name, inchi, actual_inchi)
-            print 'INVALID\n\tname:%s\n\tinchi:\t%s\n\tactual:\t%s' % data
-        i += 1
-        if i % 50 == 0:
-            print '%s/%s invalid inchis' % (j, i)
+    return verify_sample(load_map(), query_inchi_many, 'inchi', sample_size,
+                         margin, confidence, cirpy.WORKERS * 8)
 
 
 def update_map():
@@ -146,29 +325,33 @@ def update_map():
     Updates every entry in CHEM_INCHI_MAP by performing a new query.
 
     This differs from generate_map in that a query is performed for every
-    chemical and old inchis are overwritten with the new ones.
+    chemical and old inchis are overwritten with the new ones, unless the
+    query fails. Chemicals without inchis whose last failure is still fresh
+    in MISSES are skipped.
     After processing, the map is now fully synchronized with cirpy.
     """
-    bar, i = pbar(len(CHEM_INCHI_MAP)), 0
-    bar.start()
-    for name, inchi in CHEM_INCHI_MAP.items():
-        actual_inchi = query_inchi(name)
-        CHEM_INCHI_MAP[name] = actual_inchi
-        if actual_inchi != inchi:
-            print 'updated'
-        i += 1
-        bar.update(i)
-    bar.finish()
+    load_map()
+    fresh = MISSES.fresh_names()
+    names = [x for x, inchi in CHEM_INCHI_MAP.iteritems()
+             if inchi is not None or x not in fresh]
+    print 'Skipping %i recent misses' % (len(CHEM_INCHI_MAP) - len(names))
+    failed = MISSES.refresh(CHEM_INCHI_MAP, names, query_inchi_many, CHUNK)
     save_map()
-    print 'Inchi map update complete. It is now in sync with cirpy.'
+    resilience.report()
+    if failed:
+        print ('Inchi map update complete. %i entries failed and kept their '
+               'old inchis.' % failed)
+    else:
+        print 'Inchi map update complete. It is now in sync with cirpy.'
 
 
 def add_map(chemicals):
+    chemicals = list(chemicals)
     bar, i = pbar(len(chemicals)), 0
     bar.start()
-    for chem in chemicals:
-        get_inchi(chem)
-        i += 1
+    for chems in chunks(chemicals, CHUNK):
+        add_inchis(chems)
+        i += len(chems)
         bar.update(i)
     bar.finish()
     save_map()
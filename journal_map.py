@@ -0,0 +1,193 @@
+import os
+import threading
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+# journal entries written before a checkpoint compacts them in the background
+COMPACT_EVERY = 50000
+
+
+def load(path):
+    '''
+    Returns the map saved at path as a plain dict, with its journals
+    replayed, for reading it without writing to it.
+    '''
+    result = json.load(open(path)) if os.path.exists(path) else {}
+    for journal_path in journals(path):
+        replay(journal_path, result)
+    return result
+
+
+def open_map(path, label):
+    '''Returns the JournalMap at path, saying whether it existed'''
+    existed = os.path.exists(path) or any(
+        [os.path.exists(x) for x in journals(path)])
+    result = JournalMap(path)
+    if existed:
+        print 'Loaded existing %s map.' % label
+    else:
+        print 'No %s map found. Starting from scratch.' % label
+    return result
+
+
+def journals(path):
+    '''
+    Returns the journals of the map at path in the order they apply. The
+    older one is left by a checkpoint that did not finish.
+    '''
+    return [path + '.journal.old', path + '.journal']
+
+
+def replay(journal_path, result):
+    '''
+    Applies the entries of a journal to result and returns how many there
+    were, stopping at a line cut short by a crash.
+    '''
+    if not os.path.exists(journal_path):
+        return 0
+    count = 0
+    for line in open(journal_path, 'rb'):
+        if not line.endswith('\n'):
+            break
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            break
+        if len(entry) == 2:
+            result[entry[0]] = entry[1]
+        elif entry:
+            result.pop(entry[0], None)
+        else:
+            result.clear()
+        count += 1
+    return count
+
+
+class JournalMap(dict):
+    '''
+    A dict saved as a JSON snapshot at path plus a journal of the changes
+    since, one JSON line per new or changed entry, [key] per removed entry
+    and [] when the map is cleared. Each change is written
+    and flushed as it is made, so a killed process loses at most the line
+    being written, and saving costs only the changes. Once compact_every
+    changes are journaled, a background thread writes a new snapshot and
+    starts the journal over. Only one process may write to a map at a time.
+    '''
+
+    def __init__(self, path, compact_every=COMPACT_EVERY):
+        entries = json.load(open(path)) if os.path.exists(path) else {}
+        # entries journaled since the snapshot, counting those replayed
+        self.journaled = sum([replay(x, entries) for x in journals(path)])
+        dict.__init__(self, entries)
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_every = compact_every
+        self.journal = None  # opened on the first change
+        self.lock = threading.RLock()
+        self.checkpointing = threading.Lock()
+        self.compacting = False  # whether a background checkpoint is due
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self and dict.__getitem__(self, key) == value:
+                return
+            dict.__setitem__(self, key, value)
+            self.append([key, value])
+
+    def __delitem__(self, key):
+        with self.lock:
+            dict.__delitem__(self, key)
+            self.append([key])
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self:
+                return dict.pop(self, key, *default)
+            value = dict.pop(self, key)
+            self.append([key])
+            return value
+
+    def popitem(self):
+        with self.lock:
+            key, value = dict.popitem(self)
+            self.append([key])
+            return key, value
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                self[key] = default
+            return dict.__getitem__(self, key)
+
+    def clear(self):
+        with self.lock:
+            dict.clear(self)
+            self.append([])
+
+    def append(self, entry):
+        if self.journal is None:
+            self.journal = open_journal(self.journal_path)
+        self.journal.write(json.dumps(entry) + '\n')
+        self.journal.flush()
+        self.journaled += 1
+        if self.journaled >= self.compact_every and not self.compacting:
+            self.compacting = True
+            thread = threading.Thread(target=self.checkpoint)
+            thread.daemon = True
+            thread.start()
+
+    def sync(self):
+        '''Makes sure the journal is on disk, not just written'''
+        with self.lock:
+            if self.journal is not None:
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+
+    def checkpoint(self):
+        '''
+        Writes a snapshot of the map to path and empties the journal.
+        Changes made meanwhile go to a new journal.
+        '''
+        with self.checkpointing:
+            old_path = self.journal_path + '.old'
+            with self.lock:
+                if self.journal is not None:
+                    self.journal.close()
+                    self.journal = None
+                if os.path.exists(self.journal_path):
+                    if os.path.exists(old_path):
+                        # an earlier checkpoint stopped before its snapshot
+                        with open(old_path, 'ab') as f:
+                            f.write(open(self.journal_path, 'rb').read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.rename(self.journal_path, old_path)
+                snapshot = dict(self)
+                self.journaled = 0
+                self.compacting = False
+            with open(self.path + '.tmp', 'wb') as f:
+                json.dump(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(self.path + '.tmp', self.path)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+
+def open_journal(journal_path):
+    '''Opens a journal for appending, dropping a line cut short by a crash'''
+    journal = open(journal_path, 'ab+')
+    journal.seek(0, os.SEEK_END)
+    if journal.tell():
+        journal.seek(-1, os.SEEK_END)
+        if journal.read(1) != '\n':
+            journal.seek(0)
+            data = journal.read()
+            journal.truncate(data.rfind('\n') + 1)
+    return journal
@@ -0,0 +1,74 @@
+import operator
+
+OPERATORS = {'$gt': operator.gt, '$gte': operator.ge, '$lt': operator.lt,
+             '$lte': operator.le, '$ne': operator.ne}
+
+
+class Collection(object):
+    '''
+    An in-memory stand-in for the parts of a pymongo collection that
+    inchi_map.generate_map uses, over a list of documents. Queries can match
+    fields by value or with the comparison operators in OPERATORS.
+    '''
+
+    def __init__(self, documents):
+        self.documents = list(documents)
+        self.reads = 0  # documents returned by cursors so far
+        self.open = 0  # cursors found and not closed yet
+
+    def count(self):
+        return len(self.documents)
+
+    def find(self, spec=None, fields=None, timeout=True):
+        self.open += 1
+        return Cursor(self, spec or {}, fields)
+
+
+class Cursor(object):
+
+    def __init__(self, collection, spec, fields):
+        self.collection = collection
+        self.spec = spec
+        self.fields = fields
+        self.order = None
+        self.size = 0
+        self.closed = False
+
+    def sort(self, key, direction=1):
+        self.order = (key, direction)
+        return self
+
+    def batch_size(self, size):
+        self.size = size
+        return self
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.collection.open -= 1
+
+    def __iter__(self):
+        documents = [x for x in self.collection.documents if self.matches(x)]
+        if self.order is not None:
+            key, direction = self.order
+            documents.sort(key=lambda x: x.get(key), reverse=direction < 0)
+        for document in documents:
+            self.collection.reads += 1
+            yield self.project(document)
+
+    def matches(self, document):
+        for field, condition in self.spec.iteritems():
+            value = document.get(field)
+            if isinstance(condition, dict):
+                for name, operand in condition.iteritems():
+                    if not OPERATORS[name](value, operand):
+                        return False
+            elif value != condition:
+                return False
+        return True
+
+    def project(self, document):
+        if not self.fields:
+            return dict(document)
+        return dict((k, v) for k, v in document.iteritems()
+                    if k == '_id' or k in self.fields)
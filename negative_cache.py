@@ -0,0 +1,111 @@
+import time
+import cirpy
+import resilience
+from utils import pbar, chunks
+from sqlite_map import SqliteMap
+
+DB_PATH = '../data/negative_cache.db'
+DAY = 24 * 60 * 60
+# seconds a failed lookup is trusted for, by why it failed: CIR answered it
+# has no structure, CIR could not be reached, or its answer could not be read
+TTLS = {'missing': 30 * DAY, 'unavailable': 0, 'error': DAY}
+# errors of lookups that failed. Anything else is a bug, which is raised
+# rather than recorded and hidden as a miss
+LOOKUP_ERRORS = (resilience.Unavailable,) + cirpy.ERRORS
+
+
+def reason(result):
+    '''
+    Returns why a query result failed, a key of TTLS, or None if it did not.
+    Results are None for names CIR does not know, or the exception raised.
+    Raises exceptions that are not in LOOKUP_ERRORS.
+    '''
+    if result is None:
+        return 'missing'
+    if isinstance(result, resilience.Unavailable):
+        return 'unavailable'
+    if isinstance(result, LOOKUP_ERRORS):
+        return 'error'
+    if isinstance(result, Exception):
+        raise result
+    return None
+
+
+class NegativeCache(object):
+    '''
+    When and why looking up each name failed, kept in a table of DB_PATH so
+    lookups and bulk refreshes can skip names that failed recently. How long
+    a failure counts is set per reason by ttls, defaulting to TTLS.
+    '''
+
+    def __init__(self, table, path=DB_PATH, ttls=None):
+        self.store = SqliteMap(path, table=table)
+        self.ttls = dict(TTLS, **(ttls or {}))
+
+    def record(self, name, why):
+        self.store[name] = [why, time.time()]
+
+    def record_many(self, pairs):
+        '''Records (name, reason) pairs in a single transaction'''
+        now = time.time()
+        self.store.update((name, [why, now]) for name, why in pairs)
+
+    def forget(self, names):
+        '''Drops the failures of names that have since been looked up'''
+        self.store.delete(names)
+
+    def fresh(self, name):
+        '''Returns why name failed if that still counts, or None'''
+        entry = self.store.get(name)
+        if entry is not None and self.counts(entry):
+            return entry[0]
+        return None
+
+    def fresh_names(self):
+        '''Returns the set of names whose failure still counts'''
+        return set([name for name, entry in self.store.iteritems()
+                    if self.counts(entry)])
+
+    def refresh(self, entries, names, query_many, chunk_size=1000):
+        '''
+        Looks up names of entries, a dict of name -> value, again with
+        query_many, chunk_size at a time, and stores what it finds, None for
+        names CIR does not know. Names that fail otherwise keep their old
+        value. Failures are recorded and names found are forgotten. Returns
+        the number of names that kept their old value.
+        '''
+        bar, i = pbar(len(names)), 0
+        failed = 0
+        bar.start()
+        for chunk in chunks(names, chunk_size):
+            found, misses = [], []
+            for name, actual in zip(chunk, query_many(chunk)):
+                why = reason(actual)
+                if why is None:
+                    found.append(name)
+                else:
+                    misses.append((name, why))
+                if why is None or why == 'missing':
+                    if actual != entries[name]:
+                        print 'updated'
+                    entries[name] = actual
+                else:
+                    failed += 1
+                i += 1
+                bar.update(i)
+            self.forget(found)
+            self.record_many(misses)
+        bar.finish()
+        return failed
+
+    def counts(self, entry):
+        why, when = entry
+        return time.time() - when < self.ttls.get(why, 0)
+
+    def stats(self):
+        '''Returns the number of failures recorded and still counting, by reason'''
+        stats = {}
+        for name, entry in self.store.iteritems():
+            recorded, fresh = stats.get(entry[0], (0, 0))
+            stats[entry[0]] = (recorded + 1, fresh + int(self.counts(entry)))
+        return stats
@@ -1,10 +1,8 @@
-import nltk
 import string
 import itertools
 from collections import defaultdict
 import unicodedata
 from utils import *
-import nltk.data
 
 
 PUNCT = set(string.punctuation.replace('-', '').replace('+', '')
@@ -80,6 +78,7 @@ def isNumber(s):
 
 def getPos(sents, strip=True):
     """returns tuple of tagged tokens, dictionary of POS tags to words"""
+    import nltk  # slow to import, so only loaded when tagging
     if strip:
         sents = [stripPunct(s) for s in sents]
     toks = [nltk.word_tokenize(sent) for sent in sents]
@@ -162,6 +161,7 @@ def splitSentences(text):
 
 def getTree(chunker, tagged):
     """returns a tree given list of tagged words using the chunker"""
+    import nltk
     if tagged == []:
         return None
     (words, tags) = zip(*tagged)
@@ -1,16 +1,59 @@
+import os
+import sys
+import time
+import signal
+import threading
 import chemtagger
 from utils import *
 import regex as re
 from collections import defaultdict
-from nltk.stem.lancaster import LancasterStemmer
+from contextlib import contextmanager
+from multiprocessing import Pool, cpu_count
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 
-STEMMER = LancasterStemmer()
+# created by stemmer on first use since nltk is slow to import
+STEMMER = None
+# precomputed word -> stem table built from the training sentences, loaded
+# by load_stem_table on first use
+STEM_TABLE_PATH = '../data/stem_table.json'
+STEM_TABLE = None
+# bounded cache for words missing from the table, cleared when full
+STEM_CACHE = {}
+STEM_CACHE_SIZE = 100000
+STEM_STATS = {'hits': 0, 'misses': 0}
+# seconds a single pattern may run on a sentence before the sentence is
+# quarantined, None to disable. See pattern_budget.
+PATTERN_TIMEOUT = 1.0
+QUARANTINE_PATH = '../data/quarantine.txt'
+QUARANTINED = defaultdict(int)
+# engine extract matches patterns with, 'regex' or 'tokens', see match_tokens
+ENGINE = 'regex'
+TOKEN_SHAPES = {}
+# token class codes used by the token engine
+LIST_CODE, WORD_CODE, ARROW_CODE = 1, 2, 4
+WORD_TOKEN = re.compile(r'\w+', re.IGNORECASE)
+LIST_SEPARATORS = set(['and', 'with', 'andwith'])
+# opt-in timing of extract stages and pattern variants, see enable_profiling
+PROFILE = False
+PROFILE_STATS = {}
 CHEM = r'\$([^\$.]*?)\$chem'
+# characters of the tags above, which chemical names can not contain
+MARKERS = set('${}')
 CHEM_LIST = r'{([^{}.]*?)}chem_list'
 LIST_PATTERN = re.compile(
     r'(%s)(\(?,?\s*(?:and)?(?:with)?\s*%s\)?)*' % (CHEM, CHEM))
+# LIST_PATTERN with possessive steps and no groups. Every step is optional
+# or fixed text, so the greedy match is the only one and it is found in one
+# pass instead of retrying the whitespace on either side of and/with.
+LIST_SCANNER = re.compile(
+    r'\$[^\$.]*\$chem(?:\(?+,?+\s*+(?:and)?+(?:with)?+\s*+\$[^\$.]*\$chem\)?+)*+')
 PATTERNS = defaultdict(list)
+COMBINED_PATTERN = None
+FAMILY_PATTERNS = {}
 
 # pattern0: chem_list <--> chem_list
 PATTERN0 = [r'%s[\<\-\>\s]+%s']
@@ -53,33 +96,297 @@ PATTERN5 = [r'%s (?:%s) (?:%s) %s',
             ]
 
 
+# words a sentence needs before a pattern family can match it, see
+# possible_patterns. Triggers of patterns 1 and 4 may end a longer token.
+TRIGGER_SUFFIXES = {1: tuple(TRIG1.split('|')),
+                    4: tuple(TRIG4.split('|'))}
+TRIGGER_WORDS = {1: [set(TRANS.split('|'))],
+                 2: [set(TRIG2.split('|')), set(TRANS.split('|'))],
+                 3: [set(TRIG3.split('|'))],
+                 4: [set(['of'])],
+                 5: [set(TRANS5.split('|')), set(TRIG5.split('|'))],
+                 }
+
+
+# variants of each pattern family and the values filling their %s slots
+PATTERN_FAMILIES = {0: (PATTERN0, (CHEM_LIST, CHEM_LIST)),
+                    1: (PATTERN1, (TRIG1, CHEM_LIST, TRANS, CHEM_LIST)),
+                    2: (PATTERN2, (CHEM_LIST, TRIG2, TRANS, CHEM_LIST)),
+                    3: (PATTERN3, (CHEM_LIST, TRIG3, CHEM_LIST)),
+                    4: (PATTERN4, (TRIG4, CHEM_LIST)),
+                    5: (PATTERN5, (CHEM_LIST, TRANS5, TRIG5, CHEM_LIST)),
+                    }
+
+
 def expand_patterns():
     global PATTERNS
     if PATTERNS:
         return PATTERNS
-    for pattern in PATTERN0:
-        PATTERNS[0].append(
-            re.compile(pattern % (CHEM_LIST, CHEM_LIST), re.IGNORECASE))
-    for pattern in PATTERN1:
-        PATTERNS[1].append(
-            re.compile(pattern % (TRIG1, CHEM_LIST, TRANS, CHEM_LIST), re.IGNORECASE))
-    for pattern in PATTERN2:
-        PATTERNS[2].append(
-            re.compile(pattern % (CHEM_LIST, TRIG2, TRANS, CHEM_LIST), re.IGNORECASE))
-    for pattern in PATTERN3:
-        PATTERNS[3].append(
-            re.compile(pattern % (CHEM_LIST, TRIG3, CHEM_LIST), re.IGNORECASE))
-    for pattern in PATTERN4:
-        PATTERNS[4].append(
-            re.compile(pattern % (TRIG4, CHEM_LIST), re.IGNORECASE))
-    for pattern in PATTERN5:
-        PATTERNS[5].append(
-            re.compile(pattern % (CHEM_LIST, TRANS5, TRIG5, CHEM_LIST), re.IGNORECASE))
+    for pattern_id in sorted(PATTERN_FAMILIES):
+        variants, args = PATTERN_FAMILIES[pattern_id]
+        for pattern in variants:
+            PATTERNS[pattern_id].append(
+                re.compile(pattern % args, re.IGNORECASE))
     return PATTERNS
 
 
+class PatternTimeout(Exception):
+    '''Raised when a pattern runs longer than PATTERN_TIMEOUT'''
+
+
+def alarm(signum, frame):
+    raise PatternTimeout()
+
+
+@contextmanager
+def pattern_budget(pattern_id):
+    '''
+    Raises PatternTimeout(pattern_id) if the block runs longer than
+    PATTERN_TIMEOUT. The regex release that still supports python 2 does not
+    accept a timeout argument, so the budget is enforced with SIGALRM, which
+    regex checks while matching. Signals are only delivered to the main
+    thread, so the budget is not enforced in other threads.
+    '''
+    if (not PATTERN_TIMEOUT or
+            not isinstance(threading.current_thread(), threading._MainThread)):
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, alarm)
+    signal.setitimer(signal.ITIMER_REAL, PATTERN_TIMEOUT)
+    try:
+        yield
+    except PatternTimeout:
+        raise PatternTimeout(pattern_id)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def quarantine(sid, sentence, pattern_id):
+    '''Appends a sentence that ran over its time budget to QUARANTINE_PATH'''
+    QUARANTINED[pattern_id] += 1
+    with open(QUARANTINE_PATH, 'ab') as f_out:
+        line = '%s\t%s\t%s\n' % (sid, pattern_id, sentence)
+        f_out.write(line.encode('utf-8'))
+
+
+def enable_profiling(enabled=True):
+    '''
+    Turns timing of extract on or off. Stats are kept per process in
+    PROFILE_STATS as name -> [calls, matches, seconds], see profile_summary.
+    '''
+    global PROFILE
+    PROFILE = enabled
+    PROFILE_STATS.clear()
+
+
+def record(name, began, matches=0):
+    '''Adds one call that started at time began to the stats of name'''
+    stats = PROFILE_STATS.setdefault(name, [0, 0, 0.0])
+    stats[0] += 1
+    stats[1] += matches
+    stats[2] += time.time() - began
+
+
+def timed(name, func, *args):
+    '''Calls func(*args), recording its time under name when profiling'''
+    if not PROFILE:
+        return func(*args)
+    began = time.time()
+    result = func(*args)
+    record(name, began)
+    return result
+
+
+def profile_summary():
+    '''
+    Returns rows of [name, calls, matches, total seconds, mean microseconds]
+    for everything recorded while profiling, slowest first.
+    '''
+    rows = []
+    for name, (calls, matches, seconds) in PROFILE_STATS.items():
+        rows.append([name, calls, matches, seconds, seconds / calls * 1e6])
+    return sorted(rows, key=lambda x: x[3], reverse=True)
+
+
+def stem(word):
+    '''Returns STEMMER.stem(word), memoized in STEM_TABLE and STEM_CACHE'''
+    if STEM_TABLE is None:
+        load_stem_table()
+    if word in STEM_TABLE:
+        STEM_STATS['hits'] += 1
+        return STEM_TABLE[word]
+    if word in STEM_CACHE:
+        STEM_STATS['hits'] += 1
+        return STEM_CACHE[word]
+    STEM_STATS['misses'] += 1
+    if len(STEM_CACHE) >= STEM_CACHE_SIZE:
+        STEM_CACHE.clear()
+    result = STEM_CACHE[word] = stemmer().stem(word)
+    return result
+
+
+def stemmer():
+    '''Returns STEMMER, creating it on first use'''
+    global STEMMER
+    if STEMMER is None:
+        from nltk.stem.lancaster import LancasterStemmer
+        STEMMER = LancasterStemmer()
+    return STEMMER
+
+
+def load_stem_table():
+    '''Returns STEM_TABLE, loading it from STEM_TABLE_PATH on first use'''
+    global STEM_TABLE
+    if STEM_TABLE is None:
+        if os.path.exists(STEM_TABLE_PATH):
+            STEM_TABLE = json.load(open(STEM_TABLE_PATH))
+        else:
+            STEM_TABLE = {}
+    return STEM_TABLE
+
+
+def build_stem_table():
+    '''
+    input: train_sentences.json
+    output: stem_table.json
+    Stems every distinct token of the training sentences once so the table
+    can be loaded at startup instead of stemming the same words repeatedly.
+    '''
+    sentences = json.load(open('../data/train_sentences.json'))
+    bar, i = pbar(len(sentences)), 0
+    print 'Building stem table'
+    bar.start()
+    table = {}
+    for sentence in sentences.itervalues():
+        for word in sentence.split():
+            if word not in table:
+                table[word] = stemmer().stem(word)
+        i += 1
+        bar.update(i)
+    bar.finish()
+    json.dump(table, open(STEM_TABLE_PATH, 'wb'))
+    print 'Result dumped to %s' % STEM_TABLE_PATH
+
+
+def compile_matcher():
+    '''
+    Compiles a single pattern that finds every position where a pattern
+    variant could start. All variants start with either a chem_list or a
+    trigger word, so one scan for those anchors finds every candidate.
+    Also compiles one lookahead alternation per family to cheaply reject
+    candidates where no variant of that family can match.
+    '''
+    global COMBINED_PATTERN
+    if COMBINED_PATTERN is not None:
+        return COMBINED_PATTERN
+    for pattern_id, variants in expand_patterns().items():
+        FAMILY_PATTERNS[pattern_id] = re.compile(
+            '|'.join(['(?=%s)' % x.pattern for x in variants]), re.IGNORECASE)
+    triggers = sorted(set(TRIG1.split('|') + TRIG4.split('|')),
+                      key=len, reverse=True)
+    COMBINED_PATTERN = re.compile(r'(\{)|(?:%s)' % '|'.join(triggers),
+                                  re.IGNORECASE)
+    return COMBINED_PATTERN
+
+
+def possible_patterns(tokens):
+    '''
+    Returns the ids of the pattern families that can match a sentence, given
+    its stemmed tokens, by checking the tokens for each family's trigger and
+    transition words. Pattern 0 needs a token made of arrow characters since
+    two lists separated only by whitespace are merged by group_list.
+    '''
+    words = set([x.lower() for x in tokens])
+    result = []
+    for x in words:
+        if x and not x.strip('<->'):
+            result.append(0)
+            break
+    for pattern_id in sorted(TRIGGER_WORDS):
+        if pattern_id in TRIGGER_SUFFIXES:
+            suffixes = TRIGGER_SUFFIXES[pattern_id]
+            if not [x for x in words if x.endswith(suffixes)]:
+                continue
+        for required in TRIGGER_WORDS[pattern_id]:
+            if words.isdisjoint(required):
+                break
+        else:
+            result.append(pattern_id)
+    return result
+
+
+def match_patterns(sentence, pattern_ids=None):
+    '''
+    Returns a list of (pattern_id, groups) for every variant of the given
+    pattern families, or of all of them by default, where groups is what
+    pattern.findall(sentence, overlapped=True) would return.
+    The sentence is scanned once for candidate start positions and each
+    variant is only tried where some variant of its family matches.
+    '''
+    if PROFILE:
+        began = time.time()
+    list_starts, trigger_starts = [], []
+    with pattern_budget('scan'):
+        for m in compile_matcher().finditer(sentence, overlapped=True):
+            if m.group(1):
+                list_starts.append(m.start())
+            else:
+                trigger_starts.append(m.start())
+    if PROFILE:
+        record('scan', began)
+    result = []
+    for pattern_id in sorted(PATTERNS):
+        if pattern_ids is not None and pattern_id not in pattern_ids:
+            continue
+        with pattern_budget(pattern_id):
+            result.extend(match_family(sentence, pattern_id, list_starts,
+                                       trigger_starts))
+    return result
+
+
+def match_family(sentence, pattern_id, list_starts, trigger_starts):
+    '''
+    Returns (pattern_id, groups) for each variant of one pattern family,
+    given the candidate start positions found by match_patterns.
+    '''
+    if PROFILE:
+        began = time.time()
+    if pattern_id in (1, 4):
+        starts = trigger_starts
+    else:
+        starts = list_starts
+    if starts:
+        family = FAMILY_PATTERNS[pattern_id]
+        starts = [x for x in starts if family.match(sentence, x)]
+    if PROFILE:
+        record('gate %s' % pattern_id, began)
+    result = []
+    for index, pattern in enumerate(PATTERNS[pattern_id]):
+        if PROFILE:
+            began = time.time()
+        groups = []
+        for start in starts:
+            match = pattern.match(sentence, start)
+            if not match:
+                continue
+            if pattern.groups == 1:
+                groups.append(match.group(1))
+            else:
+                groups.append(match.groups(''))
+        result.append((pattern_id, groups))
+        if PROFILE:
+            record('pattern %s.%s' % (pattern_id, index), began, len(groups))
+    return result
+
+
+def list_spans(sentence):
+    '''Returns the (start, end) offsets of the chemical lists in a sentence'''
+    return [x.span() for x in LIST_SCANNER.finditer(sentence)]
+
+
 def group_list(sentence):
-    return re.sub(LIST_PATTERN, '{\g<0>}chem_list', sentence)
+    return LIST_SCANNER.sub('{\g<0>}chem_list', sentence)
 
 
 def expand_chems(matches):
@@ -94,89 +401,388 @@ def expand_chems(matches):
     return result
 
 
+def chemical_index(chemicals):
+    '''
+    Indexes chemical names by their first token. Each entry is a list of
+    (rank, tokens) where rank orders the names longest first. Names with
+    irregular spacing are skipped since they can never match a sentence
+    joined with single spaces.
+    '''
+    index = {}
+    ordered = sorted(chemicals, key=len, reverse=True)
+    for rank, tokens in enumerate([x.split(' ') for x in ordered]):
+        if '' in tokens:
+            continue
+        if tokens[0] in index:
+            index[tokens[0]].append((rank, tokens))
+        else:
+            index[tokens[0]] = [(rank, tokens)]
+    return index
+
+
+def chemical_spans(tokens, chemicals, index=None):
+    '''
+    Returns the (start, end) token spans of the chemicals that tag_chemicals
+    marks, in the order they are applied.
+    '''
+    if index is None:
+        index = chemical_index(chemicals)
+    found = []
+    for i in [i for i, token in enumerate(tokens) if token in index]:
+        for rank, name in index[tokens[i]]:
+            j = i + len(name)
+            if j == i + 1 or tokens[i:j] == name:
+                found.append((rank, i, j))
+    found.sort()
+    # a tag only rewrites the first and last token of a name, so a shorter
+    # name strictly inside a tagged one is still tagged, as before
+    spans = []
+    modified = set()
+    last_end = {}
+    for rank, i, j in found:
+        if last_end.get(rank) == i or i in modified or j - 1 in modified:
+            continue
+        if j - i > 2 and modified.intersection(xrange(i + 1, j - 1)):
+            continue
+        last_end[rank] = j
+        modified.add(i)
+        modified.add(j - 1)
+        spans.append((i, j))
+    return spans
+
+
+def tag_chemicals(sentence, chemicals, index=None):
+    '''
+    Marks every chemical in the sentence as $name$chem in one pass over the
+    tokens. Longer names win over shorter overlapping ones and two occurrences
+    of the same name that share a space are not both tagged, which is what
+    replacing each name in turn with str.replace used to do.
+    An index built by chemical_index can be passed in to reuse it across
+    sentences that share the same chemicals.
+    '''
+    tokens = sentence.split(' ')
+    spans = chemical_spans(tokens, chemicals, index)
+    if not spans:
+        return sentence
+    for i, j in spans:
+        tokens[i] = '$' + tokens[i]
+        tokens[j - 1] += '$chem'
+    return ' '.join(tokens)
+
+
+def token_shape(pattern, args):
+    '''
+    Translates a pattern variant into the sequence of token classes it
+    matches, using the values that fill its %s slots. Each class is one of
+    ('list',), ('word',) for \\w*, ('arrows',) for any number of arrow tokens,
+    ('in', words) for a token equal to one of words, or ('suffix', words) for
+    a token ending in one of words, which is how a leading trigger matches.
+    '''
+    shape = []
+    args = list(args)
+    for part in pattern.replace(r'[\<\-\>\s]+', ' <-> ').split():
+        if part in ('%s', '(?:%s)'):
+            arg = args.pop(0)
+            if arg == CHEM_LIST:
+                shape.append(('list',))
+            elif not shape:
+                shape.append(('suffix', tuple(arg.lower().split('|'))))
+            else:
+                shape.append(('in', set(arg.lower().split('|'))))
+        elif part == r'\w*':
+            shape.append(('word',))
+        elif part == '<->':
+            shape.append(('arrows',))
+        else:
+            shape.append(('in', set([part.lower()])))
+    return shape
+
+
+def token_shapes():
+    '''Returns the token shapes of every pattern variant by pattern id'''
+    if TOKEN_SHAPES:
+        return TOKEN_SHAPES
+    for pattern_id, (variants, args) in PATTERN_FAMILIES.items():
+        TOKEN_SHAPES[pattern_id] = [token_shape(x, args) for x in variants]
+    return TOKEN_SHAPES
+
+
+def token_units(tokens, chemicals):
+    '''
+    Splits the stemmed tokens of a sentence into the units the patterns see
+    once chemicals are tagged and grouped: chemical lists and single words.
+    Returns parallel lists of class codes, lowercased word text, and the
+    chemical names of each list. Like the regex CHEM, a tagged name containing
+    a period or another tag is not a chemical and its tokens stay words.
+    '''
+    spans = sorted(chemical_spans(tokens, chemicals))
+    chems, texts = {}, {}
+    for k, (i, j) in enumerate(spans):
+        name = ' '.join(tokens[i:j])
+        if k + 1 < len(spans) and spans[k + 1][0] < j:
+            name = None
+        if name is None or '.' in name or '$' in name:
+            texts[i] = '$' + texts.get(i, tokens[i])
+            texts[j - 1] = texts.get(j - 1, tokens[j - 1]) + '$chem'
+        else:
+            chems[i] = (j, name)
+    codes, words, lists = [], [], []
+    i, size = 0, len(tokens)
+    while i < size:
+        if i not in chems:
+            text = texts.get(i, tokens[i])
+            code = 0
+            if WORD_TOKEN.fullmatch(text):
+                code |= WORD_CODE
+            if text and not text.strip('<->'):
+                code |= ARROW_CODE
+            codes.append(code)
+            words.append(text.lower())
+            lists.append(None)
+            i += 1
+            continue
+        names = []
+        while True:
+            j, name = chems[i]
+            names.append(name)
+            i = j
+            if i in chems:
+                continue
+            if (i + 1 in chems and i not in texts and
+                    tokens[i] in LIST_SEPARATORS):
+                i += 1
+                continue
+            break
+        codes.append(LIST_CODE)
+        words.append('')
+        lists.append(names)
+    return codes, words, lists
+
+
+def match_shape(shape, codes, words, lists, i):
+    '''
+    Returns the chemical lists captured by shape when matched at unit i, or
+    None when it does not match there.
+    '''
+    captured = []
+    size = len(codes)
+    for slot in shape:
+        kind = slot[0]
+        if kind == 'arrows':
+            while i < size and codes[i] & ARROW_CODE:
+                i += 1
+            continue
+        if i == size:
+            return None
+        if kind == 'list':
+            if not codes[i] & LIST_CODE:
+                return None
+            captured.extend(lists[i])
+        elif kind == 'word':
+            if not codes[i] & WORD_CODE:
+                return None
+        elif kind == 'in':
+            if words[i] not in slot[1]:
+                return None
+        elif not words[i].endswith(slot[1]):
+            return None
+        i += 1
+    return captured
+
+
+def match_tokens(tokens, chemicals, pattern_ids=None):
+    '''
+    Matches the pattern families against the stemmed tokens of a sentence
+    without building the tagged and grouped sentence. Returns the same
+    (pattern_id, chemicals) pairs as expanding the regex matches, before
+    extract drops those with fewer than two chemicals.
+    '''
+    codes, words, lists = token_units(tokens, chemicals)
+    list_starts = [(i, 1) for i, code in enumerate(codes) if code & LIST_CODE]
+    trigger_starts = {}
+    result = []
+    for pattern_id, shapes in sorted(token_shapes().items()):
+        if pattern_ids is not None and pattern_id not in pattern_ids:
+            continue
+        for shape in shapes:
+            if shape[0][0] == 'list':
+                starts = list_starts
+            else:
+                suffixes = shape[0][1]
+                if suffixes not in trigger_starts:
+                    # a trigger matches once per trigger word ending the token
+                    trigger_starts[suffixes] = [
+                        (i, len([x for x in suffixes if word.endswith(x)]))
+                        for i, word in enumerate(words)
+                        if word.endswith(suffixes)]
+                starts = trigger_starts[suffixes]
+            matches = []
+            for i, count in starts:
+                captured = match_shape(shape, codes, words, lists, i)
+                if captured is not None:
+                    matches.extend([captured] * count)
+            if len([x for x in shape if x[0] == 'list']) == 1 and matches:
+                # findall returns bare strings for a single group, which
+                # expand_chems merges into one match
+                matches = [[x for y in matches for x in y]]
+            result.extend([(pattern_id, x) for x in matches])
+    return result
+
+
 def sanitize_chemicals(chemicals):
+    '''
+    Drops single characters and names containing the $ or braces that mark
+    chemicals and lists in the tagged sentence, as $name$chem and
+    {...}chem_list. The regex engine would match part of such a name, or
+    none of it, where the token engine matches all of it.
+    '''
     chemicals = set(chemicals)
-    return [x for x in chemicals if len(x) > 1]
+    return [x for x in chemicals
+            if len(x) > 1 and not MARKERS.intersection(x)]
+
+
+def stem_sentence(sentence, chemicals):
+    '''Returns the tokens of the sentence, stemmed unless part of a chemical'''
+    chems = set([y for x in chemicals for y in x.split()])
+    return [x if x in chems else stem(x) for x in sentence.split()]
 
 
 def extract(sid, sentence):
     reactants = []
-    chemicals = chemtagger.get_compounds(sid, sentence)
+    chemicals = timed('chemtagger', chemtagger.get_compounds, sid, sentence)
     if chemicals is None:
         return reactants
     chemicals = sanitize_chemicals(chemicals)
-    chems = [y for x in chemicals for y in x.split()]
-    stemmed_sentence = ' '.join([x if x in chems else STEMMER.stem(x)
-                                 for x in sentence.split()])
-    tagged_sentence = ' %s ' % stemmed_sentence
-    for chem in sorted(chemicals, key=len, reverse=True):
-        tagged_sentence = tagged_sentence.replace(
-            ' %s ' % chem, ' $%s$chem ' % chem)
-    tagged_sentence = tagged_sentence.strip()
-    grouped_sentence = group_list(tagged_sentence)
-    for pattern_id in expand_patterns():
-        for pattern in expand_patterns()[pattern_id]:
-            groups = pattern.findall(grouped_sentence, overlapped=True)
-            matches = expand_chems(groups)
-            for match in matches:
-                if match and len(match) > 1:
-                    reactants.append((pattern_id, match))
+    stemmed_tokens = timed('stemming', stem_sentence, sentence, chemicals)
+    pattern_ids = timed('prefilter', possible_patterns, stemmed_tokens)
+    if not pattern_ids:
+        return reactants
+    if ENGINE == 'tokens':
+        matches = timed('tokens', match_tokens, stemmed_tokens, chemicals,
+                        pattern_ids)
+    else:
+        stemmed_sentence = ' '.join(stemmed_tokens)
+        tagged_sentence = timed('tagging', tag_chemicals, stemmed_sentence,
+                                chemicals)
+        try:
+            with pattern_budget('group_list'):
+                grouped_sentence = timed('group_list', group_list,
+                                         tagged_sentence)
+            matched = match_patterns(grouped_sentence, pattern_ids)
+        except PatternTimeout as e:
+            quarantine(sid, sentence, e.args[0] if e.args else None)
+            return reactants
+        matches = [(pattern_id, match) for pattern_id, groups in matched
+                   for match in expand_chems(groups)]
+    for pattern_id, match in matches:
+        if match and len(match) > 1:
+            reactants.append((pattern_id, match))
     return reactants
 
 
-def main():
-    tests = [
-        [
-            0,
-            [(1, ['serine', 'glycine'])],
-            '10347152-2',
-            'As for flux through serine hydroxymethyltransferase and GCS, the conversion of serine to glycine occurred fairly rapidly, followed by GCS-mediated slow decarboxylation of the accumulated glycine',
-        ],
-        [
-            1,
-            [(1, ['3-phosphohydroxypyruvate', 'l-phosphoserine'])],
-            '10024454-0',
-            'Phosphoserine aminotransferase (PSAT; EC 2.6.1.52), a member of subgroup IV of the aminotransferases, catalyses the conversion of 3-phosphohydroxypyruvate to l-phosphoserine'
-        ],
-        [
-            2,
-            [(2, ['methionine', 'methanethiol'])],
-            '10482527-7',
-            'We therefore propose that in P. putida methionine is converted to methanethiol and then oxidized to methanesulfonate',
-        ],
-        [
-            3,
-            [(2, ['ornithine', 'N-alpha-acetylornithine']),
-             (5, ['ornithine', 'N-alpha-acetylornithine'])],
-            '10692366-1',
-            'Only two exceptions had been reported-the Enterobacteriaceae and Myxococcus xanthus (members of the gamma and delta groups of the class Proteobacteria, respectively)-in which ornithine is produced from N-alpha-acetylornithine by a deacylase, acetylornithinase (AOase) (argE encoded)',
-        ],
-        [
-            4,
-            [(4, ['l-lysine', 'l-beta-lysine'])],
-            '17944492-3',
-            'The energetics is here reported for the action of lysine 2,3-aminomutase (LAM), which catalyzes the interconversion of l-lysine and l-beta-lysine',
-        ],
-        [
-            5,
-            [(4, ['estrone', 'estradiol'])],
-            '8013376-0',
-            'Estradiol 17 beta-hydroxysteroid dehydrogenase (17 beta HSD) mediates the interconversion of estrone and estradiol in endocrine-responsive tissues such as the breast',
-        ],
-        [
-            6,
-            [(5, ['5-Hydroxymethyltryptophan', '5-hydroxy-4-methyltryptophan', '5-methyltryptophan'])],
-            '10587452-4',
-            '5-Hydroxymethyltryptophan and 5-hydroxy-4-methyltryptophan are the products from 5-methyltryptophan',
-        ],
-        [
-            7,
-            [(6, ['maltose', 'trehalose'])],
-            '18505459-2',
-            'We show that TreS from Mycobacterium smegmatis, as well as recombinant TreS produced in Escherichia coli, has amylase activity in addition to the maltose <--> trehalose interconverting activity (referred to as MTase)',
-        ],
-    ]
-    for index, output, sid, sent in tests:
+def preload():
+    '''
+    Loads the stemmer and stem table, compiles the patterns and opens the
+    chemtagger store up front, for long running processes that should not
+    pay for them on their first sentence.
+    '''
+    stemmer()
+    load_stem_table()
+    compile_matcher()
+    chemtagger.preload()
+
+
+def init_worker():
+    '''Preloads everything extract needs when an extract_many worker starts'''
+    preload()
+
+
+def extract_pair(pair):
+    '''Runs extract on a (sid, sentence) pair inside an extract_many worker'''
+    sid, sentence = pair
+    return sid, extract(sid, sentence)
+
+
+def extract_many(pairs, processes=None, chunksize=64):
+    '''
+    Runs extract on an iterable of (sid, sentence) pairs across a pool of
+    processes and yields (sid, reactants) in input order as they complete.
+    processes defaults to the number of cpus, and processes=1 runs in this
+    process without a pool. Workers add the tags they fetch to the shared
+    chemtagger store themselves.
+    '''
+    if processes == 1:
+        for sid, sentence in pairs:
+            yield sid, extract(sid, sentence)
+        return
+    # migrates the chemtagger store once here rather than in every worker
+    chemtagger.preload()
+    pool = Pool(processes or cpu_count(), init_worker)
+    try:
+        for sid, reactants in pool.imap(extract_pair, pairs, chunksize):
+            yield sid, reactants
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# sample sentences with their expected matches, [index, output, sid, sentence]
+TESTS = [
+    [
+        0,
+        [(1, ['serine', 'glycine'])],
+        '10347152-2',
+        'As for flux through serine hydroxymethyltransferase and GCS, the conversion of serine to glycine occurred fairly rapidly, followed by GCS-mediated slow decarboxylation of the accumulated glycine',
+    ],
+    [
+        1,
+        [(1, ['3-phosphohydroxypyruvate', 'l-phosphoserine'])],
+        '10024454-0',
+        'Phosphoserine aminotransferase (PSAT; EC 2.6.1.52), a member of subgroup IV of the aminotransferases, catalyses the conversion of 3-phosphohydroxypyruvate to l-phosphoserine'
+    ],
+    [
+        2,
+        [(2, ['methionine', 'methanethiol'])],
+        '10482527-7',
+        'We therefore propose that in P. putida methionine is converted to methanethiol and then oxidized to methanesulfonate',
+    ],
+    [
+        3,
+        [(2, ['ornithine', 'N-alpha-acetylornithine']),
+         (5, ['ornithine', 'N-alpha-acetylornithine'])],
+        '10692366-1',
+        'Only two exceptions had been reported-the Enterobacteriaceae and Myxococcus xanthus (members of the gamma and delta groups of the class Proteobacteria, respectively)-in which ornithine is produced from N-alpha-acetylornithine by a deacylase, acetylornithinase (AOase) (argE encoded)',
+    ],
+    [
+        4,
+        [(4, ['l-lysine', 'l-beta-lysine'])],
+        '17944492-3',
+        'The energetics is here reported for the action of lysine 2,3-aminomutase (LAM), which catalyzes the interconversion of l-lysine and l-beta-lysine',
+    ],
+    [
+        5,
+        [(4, ['estrone', 'estradiol'])],
+        '8013376-0',
+        'Estradiol 17 beta-hydroxysteroid dehydrogenase (17 beta HSD) mediates the interconversion of estrone and estradiol in endocrine-responsive tissues such as the breast',
+    ],
+    [
+        6,
+        [(5, ['5-Hydroxymethyltryptophan', '5-hydroxy-4-methyltryptophan', '5-methyltryptophan'])],
+        '10587452-4',
+        '5-Hydroxymethyltryptophan and 5-hydroxy-4-methyltryptophan are the products from 5-methyltryptophan',
+    ],
+    [
+        7,
+        [(6, ['maltose', 'trehalose'])],
+        '18505459-2',
+        'We show that TreS from Mycobacterium smegmatis, as well as recombinant TreS produced in Escherichia coli, has amylase activity in addition to the maltose <--> trehalose interconverting activity (referred to as MTase)',
+    ],
+]
+
+
+def test():
+    for index, output, sid, sent in TESTS:
         res = extract(sid, sent)
         if res == output:
             print 'Test %s passed.' % index
@@ -185,5 +791,12 @@ def main():
     chemtagger.save_map()
 
 
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == 'stem_table':
+        build_stem_table()  # generates stem_table.json
+        return
+    test()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,177 @@
+import time
+import random
+import socket
+import httplib
+import urllib2
+import threading
+from tabulate import tabulate
+
+# errors from urllib2 based clients like cirpy that are worth retrying
+NETWORK_ERRORS = (urllib2.URLError, httplib.HTTPException, socket.error)
+
+
+class Unavailable(Exception):
+    '''
+    A backend call that failed after its retries, was rejected, or was not
+    attempted
+    '''
+    pass
+
+
+class CircuitOpen(Unavailable):
+    '''A call refused without trying because its backend is down'''
+    pass
+
+
+class Backend(object):
+    '''
+    Calls to one remote service. Calls failing with a transient error are
+    retried up to retries times, waiting base_delay seconds and doubling up
+    to max_delay, with jitter so threads do not retry in step. After
+    threshold calls in a row fail, the circuit opens and calls raise
+    CircuitOpen at once for cooldown seconds. Then one call is let through,
+    which closes the circuit if it succeeds and opens it again if not. Calls,
+    retries, failures, refusals and latency are counted, see stats. Calls
+    failing with a rejected error, which the service raises for one input it
+    cannot handle, are neither retried nor counted as failures.
+    '''
+
+    def __init__(self, name, transient=NETWORK_ERRORS, rejected=(), retries=4,
+                 base_delay=0.5, max_delay=30.0, threshold=5, cooldown=60.0):
+        self.name = name
+        self.transient = transient
+        self.rejected = rejected
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0  # calls failed in a row
+        self.opened = None  # when the circuit opened, or None when closed
+        self.trying = False  # whether a call is testing an open circuit
+        self.counts = {'calls': 0, 'retries': 0, 'errors': 0, 'refused': 0,
+                       'rejected': 0, 'seconds': 0.0, 'slowest': 0.0}
+
+    def call(self, func, *args, **kwargs):
+        '''
+        Returns func(*args, **kwargs), retrying transient errors. Raises
+        Unavailable when they persist or the call is rejected, CircuitOpen
+        while the backend is down and any other error from func as it is.
+        '''
+        self.admit()
+        began = time.time()
+        attempt = 0
+        rejected = None
+        try:
+            while True:
+                try:
+                    result = func(*args, **kwargs)
+                    break
+                except self.rejected as e:
+                    rejected = e
+                    break
+                except self.transient as e:
+                    if attempt == self.retries:
+                        raise Unavailable('%s: %s' % (self.name, e))
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+                    time.sleep(delay * random.uniform(0.5, 1.0))
+                    attempt += 1
+                    self.count('retries')
+        except Exception:
+            self.record(False, time.time() - began)
+            raise
+        # a rejected call still shows the backend is up
+        self.record(True, time.time() - began)
+        if rejected is not None:
+            self.count('rejected')
+            raise Unavailable('%s rejected: %s' % (self.name, rejected))
+        return result
+
+    def admit(self):
+        '''Raises CircuitOpen unless a call may go through now'''
+        with self.lock:
+            if self.opened is None:
+                return
+            left = self.opened + self.cooldown - time.time()
+            if self.trying or left > 0:
+                self.counts['refused'] += 1
+                raise CircuitOpen('%s is down, next try in %.1fs' %
+                                  (self.name, max(left, 0.0)))
+            self.trying = True
+
+    def record(self, success, seconds):
+        with self.lock:
+            self.counts['calls'] += 1
+            self.counts['seconds'] += seconds
+            self.counts['slowest'] = max(self.counts['slowest'], seconds)
+            self.trying = False
+            if success:
+                self.failures, self.opened = 0, None
+            else:
+                self.counts['errors'] += 1
+                self.failures += 1
+                if self.opened is not None or self.failures >= self.threshold:
+                    self.opened = time.time()
+
+    def wait(self):
+        '''Sleeps until an open circuit lets a call through again'''
+        with self.lock:
+            opened = self.opened
+        if opened is not None:
+            time.sleep(max(0.0, opened + self.cooldown - time.time()))
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def stats(self):
+        '''Returns the counters of the backend and the state of its circuit'''
+        with self.lock:
+            stats = dict(self.counts)
+            stats['state'] = 'closed' if self.opened is None else 'open'
+        stats['mean'] = stats['seconds'] / stats['calls'] if stats['calls'] \
+            else 0.0
+        return stats
+
+
+def retry_refused(backend, call_many, inputs):
+    '''
+    Returns call_many(inputs), the results of calls to backend in input order
+    with exceptions as results. Inputs refused by an open circuit are tried
+    again once, after waiting out the circuit.
+    '''
+    results = call_many(inputs)
+    refused = [i for i, x in enumerate(results) if isinstance(x, CircuitOpen)]
+    if refused:
+        backend.wait()
+        retried = call_many([inputs[i] for i in refused])
+        for i, result in zip(refused, retried):
+            results[i] = result
+    return results
+
+
+# backends shared by every module that calls the same service
+BACKENDS = {}
+BACKENDS_LOCK = threading.Lock()
+
+
+def backend(name, **settings):
+    '''Returns the Backend called name, created with settings on first use'''
+    with BACKENDS_LOCK:
+        if name not in BACKENDS:
+            BACKENDS[name] = Backend(name, **settings)
+        return BACKENDS[name]
+
+
+def report():
+    '''Prints the counters of every backend used so far'''
+    table = []
+    for name in sorted(BACKENDS):
+        stats = BACKENDS[name].stats()
+        table.append([name, stats['state'], stats['calls'], stats['errors'],
+                      stats['retries'], stats['refused'], stats['rejected'],
+                      stats['mean'] * 1000, stats['slowest'] * 1000])
+    print tabulate(table, ['Backend', 'Circuit', 'Calls', 'Errors', 'Retries',
+                           'Refused', 'Rejected', 'Mean (ms)', 'Slowest (ms)'],
+                   tablefmt='simple')
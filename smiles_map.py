@@ -1,15 +1,11 @@
-import os
 import sys
-import time
 import cirpy
-import urllib2
 import parse_utils
+import resilience
+import journal_map
+import negative_cache
+import structure_store
 from utils import *
-from random import choice
-try:
-    import ujson as json
-except ImportError:
-    import json
 
 
 MAP_PATH = '../data/smiles_map.json'
@@ -20,63 +16,96 @@ BLACKLIST_COMMON = set(['heat', 'I', 'II', 'region', 'for', 'of', 'sp',
                        'compound', 'acid', 'or'])
 
 
-if os.path.exists(MAP_PATH):
-    CHEM_SMILES_MAP = json.load(open(MAP_PATH))
-    print 'Loaded existing smiles map.'
-else:
-    CHEM_SMILES_MAP = {}
-    print 'No smiles map found. Starting from scratch.'
+# retries and circuit breaker for CIR, shared with inchi_map. Queries skip
+# cirpy.CACHE, as the map is already their cache and updates need fresh ones
+CIR = resilience.backend('cir')
+CHUNK = 1000  # names resolved together in bulk updates
+# when and why names failed to resolve
+MISSES = negative_cache.NegativeCache('smiles')
+# chemical name -> smiles, a journal_map.JournalMap loaded by load_map on
+# first use, which writes each new or changed entry to disk as it is set
+CHEM_SMILES_MAP = None
 
 
 def get_smiles(chem):
     if chem in BLACKLIST_COMMON or parse_utils.isNumber(chem):
         return None
+    if CHEM_SMILES_MAP is None:
+        # the shared store answers without loading the map in this process.
+        # Once loaded, the map has entries added since the store was built
+        record = structure_store.STORE.get(chem)
+        if record is not None and 'smiles' in record:
+            return record['smiles']
+    load_map()
     if chem in CHEM_SMILES_MAP:
         return CHEM_SMILES_MAP[chem]
+    elif MISSES.fresh(chem):
+        return None  # failed recently, see negative_cache.TTLS
     else:
-        smiles = query_smiles(chem)
+        try:
+            smiles = query_smiles(chem)
+        except negative_cache.LOOKUP_ERRORS as e:
+            # only recorded in MISSES, so asked again once that expires
+            print e
+            MISSES.record(chem, negative_cache.reason(e))
+            return None
+        if smiles is None:
+            MISSES.record(chem, 'missing')
         CHEM_SMILES_MAP[chem] = smiles
         return smiles
 
 
 def query_smiles(chem):
+    """
+    Returns the smiles of the chem via cirpy, or None if CIR has none.
+    Raises resilience.Unavailable when CIR cannot be reached, see CIR.
+    """
     print 'Query for smiles'
-    try:
-        return cirpy.resolve(chem, 'smiles')
-    except urllib2.URLError:
-        print 'Sleeping for smiles'
-        time.sleep(1)
-        query_smiles(chem)
-    except Exception as e:
-        print e
-        return None
+    return CIR.call(cirpy.resolve, chem, 'smiles', cache=False)
+
+
+def query_smiles_many(chems):
+    """
+    Returns the smiles of each chem in order, resolving them concurrently
+    with cirpy.resolve_many. Chems that failed, even after waiting out an
+    open circuit once, get the exception instead, see negative_cache.reason.
+    """
+    return resilience.retry_refused(CIR, lambda x: cirpy.resolve_many(
+        x, 'smiles', call=CIR.call, cache=False), chems)
+
+
+def load_map():
+    """
+    Returns CHEM_SMILES_MAP, loading it from MAP_PATH and replaying its
+    journal on first use. Long running processes can call this up front.
+    """
+    global CHEM_SMILES_MAP
+    if CHEM_SMILES_MAP is None:
+        CHEM_SMILES_MAP = journal_map.open_map(MAP_PATH, 'smiles')
+    return CHEM_SMILES_MAP
 
 
 def save_map():
-    json.dump(CHEM_SMILES_MAP, open(MAP_PATH, 'wb'))
+    """Syncs the journal of the map, whose entries are already written"""
+    if CHEM_SMILES_MAP is None:
+        return  # never loaded, so nothing changed
+    CHEM_SMILES_MAP.sync()
     print 'Smiles map saved successfully.'
 
 
-def verify_map():
+def verify_map(sample_size=2000, margin=0.02, confidence=0.95):
     """
-    Randomly selects entries from smiles map and checks if it is valid.
+    Estimates the share of entries in the smiles map that are out of date.
 
     This is a tool to verify the correctness of the map and estimate
     whether it needs to be updated via update_map().
+    A uniform sample of sample_size names is re-resolved concurrently until
+    the stale share is known to within margin, see utils.verify_sample.
+    Prints and returns a report of the estimate.
     This method does not modify the map in any way.
     """
-    smiles_map = CHEM_SMILES_MAP.items()
-    i, j = 0, 0
-    while True:
-        name, smiles = choice(smiles_map)
-        actual_smiles = query_smiles(name)
-        if actual_smiles != smiles:
-            j += 1
-            data = (name, smiles, actual_smiles)
-            print 'INVALID\n\tname:%s\n\tsmiles:\t%s\n\tactual:\t%s' % data
-        i += 1
-        if i % 50 == 0:
-            print '%s/%s invalid smiles' % (j, i)
+    return verify_sample(load_map(), query_smiles_many, 'smiles', sample_size,
+                         margin, confidence, cirpy.WORKERS * 8)
 
 
 def update_map():
@@ -84,21 +113,23 @@ def update_map():
     Updates every entry in CHEM_SMILES_MAP by performing a new query.
 
     A new cirpy query is performed for every chemical and old smiles
-    are overwritten with the new ones.
+    are overwritten with the new ones, unless the query fails. Chemicals
+    without smiles whose last failure is still fresh in MISSES are skipped.
     After processing, the map is now fully synchronized with cirpy.
     """
-    bar, i = pbar(len(CHEM_SMILES_MAP)), 0
-    bar.start()
-    for name, smiles in CHEM_SMILES_MAP.items():
-        actual_smiles = query_smiles(name)
-        CHEM_SMILES_MAP[name] = actual_smiles
-        if actual_smiles != smiles:
-            print 'updated'
-        i += 1
-        bar.update(i)
-    bar.finish()
+    load_map()
+    fresh = MISSES.fresh_names()
+    names = [x for x, smiles in CHEM_SMILES_MAP.iteritems()
+             if smiles is not None or x not in fresh]
+    print 'Skipping %i recent misses' % (len(CHEM_SMILES_MAP) - len(names))
+    failed = MISSES.refresh(CHEM_SMILES_MAP, names, query_smiles_many, CHUNK)
     save_map()
-    print 'Smiles map update complete. It is now in sync with cirpy.'
+    resilience.report()
+    if failed:
+        print ('Smiles map update complete. %i entries failed and kept their '
+               'old smiles.' % failed)
+    else:
+        print 'Smiles map update complete. It is now in sync with cirpy.'
 
 
 def main():
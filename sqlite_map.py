@@ -0,0 +1,135 @@
+import os
+import sqlite3
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+
+class SqliteMap(object):
+    '''
+    A dict of string keys to JSON values kept in a SQLite file, so lookups
+    and writes touch one entry instead of the whole map. Every write is its
+    own transaction in a write-ahead log, so a crash loses at most the write
+    in progress. Each process opens its own connection on first use, which
+    keeps the map usable from forked workers. Several maps can share a file
+    as different tables. When the table does not exist yet, it is filled from
+    the JSON dump at json_path if there is one, in the same transaction that
+    creates it, so an interrupted migration is run again on the next connect.
+    '''
+
+    def __init__(self, path, json_path=None, table='map'):
+        self.path = path
+        self.json_path = json_path
+        self.table = table
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        if self.pid == os.getpid():
+            return self.connection
+        # waits on writers in other processes instead of failing
+        connection = sqlite3.connect(self.path, timeout=60,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        if not self.exists(connection):
+            # other processes creating the table wait here, then find it
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                if not self.exists(connection):
+                    connection.execute('CREATE TABLE %s (key TEXT PRIMARY '
+                                       'KEY, value TEXT NOT NULL)' % self.table)
+                    if self.json_path and os.path.exists(self.json_path):
+                        self.migrate(connection, self.json_path)
+            except BaseException:
+                connection.execute('ROLLBACK')
+                connection.close()
+                raise
+            connection.execute('COMMIT')
+        self.connection, self.pid = connection, os.getpid()
+        return connection
+
+    def exists(self, connection):
+        return connection.execute(
+            'SELECT 1 FROM sqlite_master WHERE type = ? AND name = ?',
+            ('table', self.table)).fetchone() is not None
+
+    def migrate(self, connection, json_path):
+        '''
+        Copies every entry of a JSON dump of the map into the table, inside
+        the transaction of connection that created it.
+        '''
+        entries = json.load(open(json_path))
+        connection.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)'
+                               % self.table, ((k, json.dumps(v))
+                                              for k, v in entries.iteritems()))
+        print 'Migrated %i entries from %s to %s' % (len(entries), json_path,
+                                                     self.path)
+
+    def __getitem__(self, key):
+        row = self.connect().execute('SELECT value FROM %s WHERE key = ?'
+                                     % self.table, (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.connect().execute('SELECT 1 FROM %s WHERE key = ?'
+                                      % self.table, (key,)).fetchone() is not None
+
+    def __setitem__(self, key, value):
+        self.connect().execute('INSERT OR REPLACE INTO %s VALUES (?, ?)'
+                               % self.table, (key, json.dumps(value)))
+
+    def update(self, pairs):
+        '''Writes (key, value) pairs in a single transaction'''
+        connection = self.connect()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)'
+                                   % self.table,
+                                   ((k, json.dumps(v)) for k, v in pairs))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def delete(self, keys):
+        '''Removes keys in a single transaction, ignoring missing ones'''
+        connection = self.connect()
+        connection.execute('BEGIN')
+        try:
+            connection.executemany('DELETE FROM %s WHERE key = ?' % self.table,
+                                   ((k,) for k in keys))
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def __len__(self):
+        return self.connect().execute('SELECT COUNT(*) FROM %s'
+                                      % self.table).fetchone()[0]
+
+    def iteritems(self):
+        # fetched up front so writes while iterating do not affect the cursor
+        rows = self.connect().execute('SELECT key, value FROM %s'
+                                      % self.table).fetchall()
+        for key, value in rows:
+            yield key, json.loads(value)
+
+    def checkpoint(self):
+        '''Folds the write-ahead log back into the database file'''
+        self.connect().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.connection.close()
+        self.connection, self.pid = None, None
@@ -0,0 +1,194 @@
+import os
+import sys
+import mmap
+import zlib
+import shutil
+import unicodedata
+import journal_map
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+STORE_PATH = '../data/structures'
+SHARDS = 16
+# the fields of a record, each left out when it was never looked up and
+# None when the lookup found nothing
+FIELDS = ['smiles', 'inchi', 'canonical_inchi']
+
+
+def normalize(name):
+    '''
+    Returns the key of a chemical name: unicode normalized and with
+    whitespace collapsed to single spaces, as utf-8. Case is kept, as names
+    like CO and Co are different chemicals. The inchi map is keyed by
+    lowercased names already, so its records are found by lowercased names.
+    '''
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = ' '.join(unicodedata.normalize('NFC', name).split())
+    return name.encode('utf-8')
+
+
+def shard_of(key, shards):
+    return (zlib.crc32(key) & 0xffffffff) % shards
+
+
+class StructureStore(object):
+    '''
+    Read-only records of name -> {smiles, inchi, canonical_inchi} written by
+    build to a directory of shards. Each shard is a file of lines of key, tab
+    and JSON record, sorted by key, which is memory mapped on first use and
+    binary searched. The mapping is opened again in forked processes, and
+    the operating system shares the pages between all of them.
+    '''
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.shards = None
+        self.pid = None
+
+    def open(self):
+        if self.pid == os.getpid():
+            return self.shards
+        shards = []
+        meta_path = os.path.join(self.path, 'meta.json')
+        if os.path.exists(meta_path):
+            meta = json.load(open(meta_path))
+            for i in range(meta['shards']):
+                f = open(shard_path(self.path, i), 'rb')
+                size = os.fstat(f.fileno()).st_size
+                # empty files can not be mapped, and hold nothing anyway
+                shards.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                              if size else None)
+                f.close()
+        self.shards, self.pid = shards, os.getpid()
+        return shards
+
+    def get(self, name, default=None):
+        '''Returns the record of name as a dict of FIELDS, or default'''
+        shards = self.open()
+        if not shards:
+            return default
+        key = normalize(name)
+        value = search(shards[shard_of(key, len(shards))], key)
+        return default if value is None else json.loads(value)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def close(self):
+        if self.pid == os.getpid():
+            for shard in self.shards:
+                if shard is not None:
+                    shard.close()
+        self.shards, self.pid = None, None
+
+
+def search(data, key):
+    '''Returns the JSON record of key in a mapped shard, or None'''
+    if data is None:
+        return None
+    low, high = 0, len(data)
+    while low < high:
+        middle = (low + high) // 2
+        start = data.rfind('\n', 0, middle) + 1
+        end = data.find('\n', start)
+        tab = data.find('\t', start, end)
+        line_key = data[start:tab]
+        if line_key == key:
+            return data[tab + 1:end]
+        elif line_key < key:
+            low = end + 1
+        else:
+            high = start
+    return None
+
+
+def shard_path(path, i):
+    return os.path.join(path, 'shard-%03i.tsv' % i)
+
+
+def build(records, path=STORE_PATH, shards=SHARDS):
+    '''
+    Writes a store of records, (name, record dict) pairs, to path, replacing
+    any store there. Records of names with the same key are merged, with
+    values kept over None. Where two of them have different values for a
+    field, like names differing only in whitespace that CIR answered
+    differently, the first value is kept and the conflict is counted and
+    printed with a few examples.
+    '''
+    merged = {}
+    conflicts = []
+    for name, record in records:
+        key = normalize(name)
+        if not key:
+            continue
+        entry = merged.setdefault(key, {})
+        for field, value in record.iteritems():
+            if entry.get(field) is None:
+                entry[field] = value
+            elif value is not None and value != entry[field]:
+                conflicts.append((key, field, entry[field], value))
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    keys = [[] for i in range(shards)]
+    for key in merged:
+        keys[shard_of(key, shards)].append(key)
+    for i in range(shards):
+        with open(shard_path(temp_path, i), 'wb') as f:
+            for key in sorted(keys[i]):
+                f.write('%s\t%s\n' % (key, json.dumps(merged[key])))
+    json.dump({'shards': shards, 'records': len(merged),
+               'conflicts': len(conflicts)},
+              open(os.path.join(temp_path, 'meta.json'), 'wb'))
+    # processes with the old store mapped keep reading it until they reopen
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+    if conflicts:
+        print 'Conflicting values: %i, kept the first of each' % len(
+            conflicts)
+        for conflict in conflicts[:10]:
+            print '\t%r %s: kept %r over %r' % conflict
+    return len(merged)
+
+
+def map_records(inchi_path, smiles_path, canonicalize=None):
+    '''
+    Generates (name, record) pairs from the inchi and smiles maps, with
+    their journals replayed. canonicalize turns an inchi into its canonical inchi when
+    given, see inchi_map.canonicalize_inchi.
+    '''
+    for name, smiles in journal_map.load(smiles_path).iteritems():
+        yield name, {'smiles': smiles}
+    for name, inchi in journal_map.load(inchi_path).iteritems():
+        record = {'inchi': inchi}
+        if canonicalize is not None:
+            record['canonical_inchi'] = canonicalize(inchi)
+        yield name, record
+
+
+# the store shared by inchi_map and smiles_map
+STORE = StructureStore()
+
+
+def main():
+    '''
+    Builds STORE_PATH from the inchi and smiles maps.
+    usage: python structure_store.py build
+    '''
+    if len(sys.argv) == 2 and sys.argv[1] == 'build':
+        import inchi_map
+        import smiles_map
+        count = build(map_records(inchi_map.MAP_PATH, smiles_map.MAP_PATH,
+                                  inchi_map.canonicalize_inchi))
+        print 'Wrote %i structures to %s' % (count, STORE_PATH)
+        return
+    print 'Wrong number of arguments. Usage: python structure_store.py build'
+
+
+if __name__ == '__main__':
+    main()
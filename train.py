@@ -68,22 +68,33 @@ def tag_sentences():
     Tags the chemicals in each sentence using ChemicalTagger 
     (http://chemicaltagger.ch.cam.ac.uk/). This method communicates with 
     ChemicalTagger through a custom REST API running on pathway.berkeley.edu
+    Returns the number of sentences that could not be tagged, in which case
+    nothing is dumped. Those tagged are cached, so running again only sends
+    the rest.
     '''
     sentences = json.load(open('../data/train_sentences.json'))
     bar, i = pbar(len(sentences)), 0
     print 'Tagging chemicals in sentences'
     bar.start()
     chemicals = {}
-    for sid, sentence in sentences.iteritems():
-        chems = chemtagger.get_compounds(sid, sentence)
-        if chems:
+    untagged = []
+    for sid, chems in chemtagger.get_compounds_many(sentences.iteritems()):
+        if chems is None:
+            untagged.append(sid)
+        elif chems:
             chemicals[sid] = chems
         i += 1
         bar.update(i)
     bar.finish()
+    if untagged:
+        print 'Could not tag %i sentences, e.g. %s' % (
+            len(untagged), ', '.join(sorted(untagged)[:10]))
+        print 'Not dumping ../data/train_tag_sentences.json'
+        return len(untagged)
     json.dump(chemicals, open('../data/train_tag_sentences.json', 'wb'),
               indent=2, sort_keys=True)
     print 'Result dumped to ../data/train_tag_sentences.json'
+    return 0
 
 
 def get_overlap(chemicals_list):
@@ -402,8 +413,10 @@ def main():
             match_name()  # generates train_match_name.json
             return
         elif command == 'tag_sentences':
-            tag_sentences()  # generates train_tag_sentences.json
+            untagged = tag_sentences()  # generates train_tag_sentences.json
             chemtagger.save_map()
+            if untagged:
+                sys.exit(1)
             return
         elif command == 'match_inchi':
             match_inchi()  # train_match_inchi.json
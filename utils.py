@@ -1,6 +1,10 @@
 import itertools
 import progressbar
 import pprint
+import threading
+import Queue
+import random
+import math
 
 pr = pprint.PrettyPrinter(indent=2)
 
@@ -125,6 +129,148 @@ def chunks(l, n):
         yield l[i:i + n]
 
 
+def read_ahead(iterable, size):
+    '''
+    Iterates over iterable in a background thread, at most size items ahead
+    of the caller, so slow reads like database cursors overlap with work on
+    the items already read. Errors while reading are raised in the caller.
+    When the caller closes the generator, the thread stops reading and
+    closes iterable if it can be closed, like a generator over a cursor.
+    '''
+    queue = Queue.Queue(size)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    thread = threading.Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+def reservoir_sample(iterable, size, rng=random):
+    '''
+    Returns size items of iterable chosen uniformly at random, or all of
+    them if there are fewer, in one pass that keeps only the sample.
+    '''
+    sample = []
+    for i, item in enumerate(iterable):
+        if i < size:
+            sample.append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                sample[j] = item
+    return sample
+
+
+def z_score(confidence):
+    '''Returns how many deviations hold confidence of a normal distribution'''
+    low, high = 0.0, 10.0
+    for i in range(60):
+        middle = (low + high) / 2
+        if math.erf(middle / math.sqrt(2)) < confidence:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def wilson_interval(hits, total, confidence=0.95):
+    '''
+    Returns the (low, high) Wilson score interval of the rate hits / total,
+    which unlike the normal interval stays sensible for rates near 0.
+    '''
+    if total == 0:
+        return 0.0, 1.0
+    z = z_score(confidence)
+    rate = float(hits) / total
+    scale = 1 + z * z / total
+    centre = (rate + z * z / (2 * total)) / scale
+    spread = z * math.sqrt(rate * (1 - rate) / total +
+                           z * z / (4 * total * total)) / scale
+    return max(0.0, centre - spread), min(1.0, centre + spread)
+
+
+def verify_sample(entries, query_many, label, sample_size=2000,
+                  margin=0.02, confidence=0.95, round_size=64):
+    '''
+    Estimates the share of entries, a dict of name -> value, that are out of
+    date. A uniform sample of sample_size names is taken in one pass and
+    checked with query_many, which returns the current value of each name
+    or the exception it failed with, round_size at a time until the
+    confidence interval of the stale share is within margin of the estimate
+    or the sample runs out. Prints and returns a report of the estimate,
+    with label naming the values, see print_sample_report.
+    '''
+    sample = reservoir_sample(entries.iteritems(), sample_size)
+    random.shuffle(sample)
+    checked, failed, stale = 0, 0, []
+    low, high = 0.0, 1.0
+    for chunk in chunks(sample, round_size):
+        names = [name for name, value in chunk]
+        for (name, value), actual in zip(chunk, query_many(names)):
+            if isinstance(actual, Exception):
+                failed += 1
+                continue
+            checked += 1
+            if actual != value:
+                stale.append((name, value, actual))
+        low, high = wilson_interval(len(stale), checked, confidence)
+        if checked >= 30 and (high - low) / 2 <= margin:
+            break
+    report = {'map': len(entries), 'sampled': len(sample),
+              'checked': checked, 'failed': failed, 'stale': len(stale),
+              'rate': float(len(stale)) / checked if checked else None,
+              'low': low, 'high': high, 'confidence': confidence,
+              'label': label, 'examples': stale[:10]}
+    print_sample_report(report)
+    return report
+
+
+def print_sample_report(report):
+    '''Prints a report of verify_sample'''
+    print 'Checked %i of %i sampled names from a map of %i, %i failed' % (
+        report['checked'], report['sampled'], report['map'], report['failed'])
+    if report['checked']:
+        print 'Stale: %i (%.1f%%, %i%% interval %.1f%% to %.1f%%)' % (
+            report['stale'], report['rate'] * 100,
+            report['confidence'] * 100, report['low'] * 100,
+            report['high'] * 100)
+    for name, value, actual in report['examples']:
+        print 'INVALID\n\tname:%s\n\t%s:\t%s\n\tactual:\t%s' % (
+            name, report['label'], value, actual)
+
+
 def main():
     '''Put test code here'''
     pass